@@ -0,0 +1,59 @@
+""" airtable_writer.py
+
+Benchmarks :obj:`airtable_request.AirtableWriter` against a local Airtable stand-in that answers
+with a fixed latency and enforces Airtable's 5 requests/second limit.
+
+Usage:
+    python benchmarks/airtable_writer.py [--records 500] [--latency 0.3]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault('AIRTABLE_API_KEY', 'benchmark')
+
+from airtable_request import AIRTABLE_RATE_LIMIT, MAX_AIRTABLE_PATCH, AirtableTable, AirtableWriter, TokenBucket
+from stubs import StubAirtable
+
+
+def run(records: int, latency: float, max_in_flight: int) -> dict:
+    """ Writes `records` records in MAX_AIRTABLE_PATCH chunks and reports the throughput """
+    with StubAirtable(latency=latency, rate_limit=AIRTABLE_RATE_LIMIT) as stub:
+        table = AirtableTable('base', 'table', api_key='benchmark', api_url=stub.url + '/v0')
+        writer = table.writer = AirtableWriter(table.request, TokenBucket(0.9 * AIRTABLE_RATE_LIMIT, capacity=1),
+                                               max_in_flight=max_in_flight)
+
+        start = time.perf_counter()
+        for offset in range(0, records, MAX_AIRTABLE_PATCH):
+            chunk = [{'id': 'rec%d' % i, 'fields': {'lastName': 'x'}}
+                     for i in range(offset, min(offset + MAX_AIRTABLE_PATCH, records))]
+            writer.submit('patch', {'records': chunk, 'typecast': True})
+        failed = writer.wait()
+        elapsed = time.perf_counter() - start
+
+        return {
+            'in_flight': max_in_flight,
+            'seconds': elapsed,
+            'requests_per_second': (stub.requests - stub.rate_limited) / elapsed,
+            'rate_limited': stub.rate_limited,
+            'failed': len(failed),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.3)
+    args = parser.parse_args()
+
+    print('rate limit: %d req/s, latency: %.0f ms' % (AIRTABLE_RATE_LIMIT, args.latency * 1000))
+    for max_in_flight in (1, 2, 4, 8):
+        result = run(args.records, args.latency, max_in_flight)
+        print('in flight: {in_flight:>2}  {seconds:6.2f}s  {requests_per_second:5.2f} req/s  '
+              '429s: {rate_limited}  failed: {failed}'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
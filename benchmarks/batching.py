@@ -0,0 +1,66 @@
+""" batching.py
+
+Benchmarks the HTTP round trips of a sync run with the batched Gcal writes of
+:obj:`calendar_request.Calendar` on and off, against the local Airtable and Google Calendar
+stand-ins of :mod:`stubs`, loaded with a synthetic table.
+
+Round trips are the HTTP requests received by the stand-ins: with batching on, the Gcal inserts
+and patches of up to 50 records travel in a single round trip ("batched" counts those calls).
+With a per-request `--latency`, the run time shows what the saved round trips are worth against
+the real APIs.
+
+Usage:
+    python benchmarks/batching.py [--records 100 1000] [--changed 0.2] [--latency 0.05]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault('AIRTABLE_API_KEY', 'benchmark')
+
+from calendar_request import Calendar
+from sync import stand_ins
+from sync_script import get_active_records, update_records
+
+
+def run(size: int, changed: float, latency: float, batch: bool, seed: int = 0) -> dict:
+    """ Syncs a fresh synthetic table once, with or without batched Gcal writes, and returns the measurements """
+    with stand_ins(size, changed, latency, None, seed) as (table, calendar, airtable, gcal):
+        calendar = Calendar(calendar.calendar_id, batch=batch, service=calendar.service)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            failed = update_records(calendar, get_active_records(table=table), table=table)
+        elapsed = time.perf_counter() - start
+        return {
+            'seconds': elapsed,
+            'airtable_calls': airtable.requests,
+            'gcal_calls': gcal.requests,
+            'gcal_batched': gcal.batched,
+            'failed': sum(len(payload['records']) for payload, _ in failed),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--changed', type=float, default=0.2, help='fraction of records needing a sync')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per API request')
+    args = parser.parse_args()
+
+    print('%8s %6s %9s %11s %9s %10s %9s %7s' % (
+        'records', 'batch', 'at trips', 'gcal trips', 'batched', 'trips/rec', 'seconds', 'failed'))
+    for size in args.records:
+        for batch in (False, True):
+            result = run(size, args.changed, args.latency, batch)
+            print('%8d %6s %9d %11d %9d %10.3f %9.2f %7d' % (
+                size, 'on' if batch else 'off', result['airtable_calls'], result['gcal_calls'],
+                result['gcal_batched'], (result['airtable_calls'] + result['gcal_calls']) / size,
+                result['seconds'], result['failed']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+""" bulk.py
+
+Benchmarks :func:`backfill.backfill` and :func:`backfill.import_events` against the local Airtable
+and Google Calendar stand-ins of :mod:`stubs`, loaded with a never synced table (or with a calendar
+of events created directly in Gcal), under Airtable's rate limit.
+
+Reports records/minute, API calls per record and 429s, and checks that every record (event) was
+synced exactly once.
+
+Usage:
+    python benchmarks/bulk.py [--records 1000 5000] [--latency 0] [--rate-limit 5] [--import]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault('AIRTABLE_API_KEY', 'benchmark')
+
+from airtable_request import AirtableTable, TokenBucket
+from backfill import backfill, import_events
+from calendar_request import Calendar, build_service, get_transport, record_id_of
+from state_store import StateStore
+from stubs import StubAirtable, StubCalendar, historical_table, untagged_events
+from sync import UNLIMITED_RATE
+
+
+def run(size: int, latency: float, rate_limit: float, import_mode: bool) -> dict:
+    """ Backfills (or imports) a fresh table once and returns the measurements """
+    records = dict() if import_mode else historical_table(size)
+    with StubAirtable(records, latency, rate_limit) as airtable, StubCalendar(latency) as gcal:
+        if import_mode:
+            gcal.events.update(untagged_events(size))
+        table = AirtableTable('appBenchmark', 'Tasks', api_key='benchmark', api_url=airtable.url + '/v0')
+        table.writer.rate_limiter = TokenBucket(0.9 * rate_limit if rate_limit else UNLIMITED_RATE, capacity=1)
+        service = build_service(get_transport(gcal.http()))
+        calendar = Calendar('benchmark', batch=True, service=service)
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if import_mode:
+                progress = import_events(calendar, table, StateStore())
+            else:
+                progress = backfill(calendar, table, StateStore())
+        elapsed = time.perf_counter() - start
+
+        if import_mode:
+            synced = sum(1 for event in gcal.events.values() if record_id_of(event))
+            linked = len({fields.get('calendarEventId') for fields in airtable.records.values()})
+            complete = synced == linked == len(airtable.records) == size
+        else:
+            live = [event for event in gcal.events.values() if event['status'] != 'cancelled']
+            synced = sum(1 for fields in airtable.records.values() if fields.get('lastDeadline'))
+            complete = synced == len(live) == size
+
+        return {
+            'seconds': elapsed,
+            'airtable_calls': airtable.requests,
+            'gcal_calls': gcal.requests,
+            'rate_limited': airtable.rate_limited + gcal.rate_limited,
+            'failed': progress['failed'],
+            'complete': complete,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, nargs='+', default=[1000, 5000])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per API request')
+    parser.add_argument('--rate-limit', type=float, default=5, help='Airtable requests/second (0 for unlimited)')
+    parser.add_argument('--import', dest='import_mode', action='store_true', help='benchmark the Gcal import')
+    args = parser.parse_args()
+
+    print('%8s %10s %9s %10s %9s %9s %6s %7s %9s' % (
+        'records', 'rec/min', 'seconds', 'calls/rec', 'at calls', 'gcal', '429s', 'failed', 'complete'))
+    for size in args.records:
+        result = run(size, args.latency, args.rate_limit or None, args.import_mode)
+        print('%8d %10.0f %9.1f %10.3f %9d %9d %6d %7d %9s' % (
+            size, size / result['seconds'] * 60, result['seconds'],
+            (result['airtable_calls'] + result['gcal_calls']) / size,
+            result['airtable_calls'], result['gcal_calls'], result['rate_limited'], result['failed'],
+            result['complete']))
+
+
+if __name__ == '__main__':
+    main()
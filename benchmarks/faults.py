@@ -0,0 +1,120 @@
+""" faults.py
+
+Benchmarks how much of a sync run completes when the local Airtable and Google Calendar stand-ins
+of :mod:`stubs` fail a fraction of their requests (5xx, 429s with `Retry-After`, dropped
+connections, failed calls inside Gcal batches).
+
+A fresh synthetic table is synced once per error rate, with the retries of :mod:`http_client` and
+without them. The completed-work ratio is the fraction of the out-of-sync records that end up in
+sync in both Airtable and Gcal. Every record left out of sync must be reported as failed by the
+run: "silent" counts the ones that were not, e.g. marked synced in Airtable while their event was
+never written.
+
+Usage:
+    python benchmarks/faults.py [--records 1000] [--changed 0.2] [--error-rates 0.05 0.1 0.2 0.3]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault('AIRTABLE_API_KEY', 'benchmark')
+
+import calendar_request
+import http_client
+from airtable_request import failed_records
+from sync import stand_ins
+from sync_script import GCAL_COLOR_MAPPING, get_active_records, update_records
+
+
+def in_sync(fields: dict, events: dict) -> bool:
+    """ Whether a record and its event both reflect the record's `Name`, `Deadline` and `Status` """
+    status = fields.get('Status')
+    if fields.get('lastName') != fields['Name'] or fields.get('lastDeadline') != fields['Deadline']:
+        return False
+    if status in GCAL_COLOR_MAPPING and fields.get('lastStatus') != 'Done':
+        return False
+    event = events.get(fields.get('calendarEventId'))
+    if event is None or event['status'] == 'cancelled':
+        return False
+    return (event.get('summary') == fields['Name'] and event['start']['dateTime'][0:10] == fields['Deadline']
+            and (status not in GCAL_COLOR_MAPPING or event.get('colorId') == GCAL_COLOR_MAPPING[status]))
+
+
+def marked_synced(fields: dict) -> bool:
+    """ Whether Airtable considers a record synced (the next run would skip it) """
+    return (fields.get('lastName') == fields['Name'] and fields.get('lastDeadline') == fields['Deadline']
+            and (fields.get('Status') not in GCAL_COLOR_MAPPING or fields.get('lastStatus') == 'Done'))
+
+
+def run(size: int, changed: float, error_rate: float, retries: bool, seed: int = 0) -> dict:
+    """ Syncs a fresh synthetic table once under injected faults and returns the measurements """
+    with stand_ins(size, changed, 0.0, None, seed, error_rate) as (table, calendar, airtable, gcal):
+        out_of_sync = {record_id for record_id, fields in airtable.records.items()
+                       if not in_sync(fields, gcal.events)}
+        if not retries:
+            table.session.retrier.max_retries = 0
+            calendar.service._http.retrier.max_retries = 0
+
+        start = time.perf_counter()
+        aborted = False
+        reported = set()
+        with contextlib.redirect_stdout(io.StringIO()), \
+                _patched(calendar_request, MAX_RETRIES=calendar_request.MAX_RETRIES if retries else 0):
+            try:
+                reported = set(failed_records(update_records(calendar, get_active_records(table=table), table=table)))
+            except Exception:
+                aborted = True
+        elapsed = time.perf_counter() - start
+
+        completed = {record_id for record_id in out_of_sync if in_sync(airtable.records[record_id], gcal.events)}
+        silent = {record_id for record_id in out_of_sync - completed
+                  if marked_synced(airtable.records[record_id]) and record_id not in reported}
+        return {
+            'seconds': elapsed,
+            'out_of_sync': len(out_of_sync),
+            'completed': len(completed) / len(out_of_sync) if out_of_sync else 1.0,
+            'reported': len(reported),
+            'silent': len(silent),
+            'faults': airtable.faults + gcal.faults,
+            'aborted': aborted,
+        }
+
+
+@contextlib.contextmanager
+def _patched(module, **values):
+    """ Temporarily sets module attributes """
+    previous = {name: getattr(module, name) for name in values}
+    for name, value in values.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(module, name, value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=1000)
+    parser.add_argument('--changed', type=float, default=0.2, help='fraction of records needing a sync')
+    parser.add_argument('--error-rates', type=float, nargs='+', default=[0.05, 0.1, 0.2, 0.3])
+    parser.add_argument('--backoff', type=float, default=0.05, help='base backoff in seconds (1s in production)')
+    args = parser.parse_args()
+    http_client.BACKOFF_BASE = args.backoff
+
+    print('%6s %8s %9s %10s %9s %7s %7s %8s %8s' % (
+        'errors', 'retries', 'seconds', 'completed', 'reported', 'silent', 'faults', 'aborted', 'records'))
+    for error_rate in args.error_rates:
+        for retries in (False, True):
+            result = run(args.records, args.changed, error_rate, retries)
+            print('%5.0f%% %8s %9.2f %9.1f%% %9d %7d %7d %8s %8d' % (
+                error_rate * 100, 'on' if retries else 'off', result['seconds'], result['completed'] * 100,
+                result['reported'], result['silent'], result['faults'], result['aborted'], result['out_of_sync']))
+
+
+if __name__ == '__main__':
+    main()
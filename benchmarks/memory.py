@@ -0,0 +1,137 @@
+""" memory.py
+
+Benchmarks the memory a sync holds on to with a large active set, against the local Airtable and
+Google Calendar stand-ins of :mod:`stubs`, loaded with a synthetic table.
+
+Two things are measured:
+    - model: the memory retained by the parsed active records, kept as the dicts of the API
+      responses versus as :obj:`record_model.Record`, and the time taken to parse them
+    - sync: the peak Python memory allocated by :func:`sync_script.update_records` over the whole
+      table, with and without a :obj:`scheduler.TimeBudget` (which holds a look-ahead window of
+      records to prioritize them), along with the records/sec of the run
+
+The stand-ins run in a child process, so that only the allocations of the sync itself are traced.
+
+Usage:
+    python benchmarks/memory.py [--records 10000 50000] [--changed 0.2]
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault('AIRTABLE_API_KEY', 'benchmark')
+
+from funcy import chunks
+
+import record_model
+from airtable_request import MAX_AIRTABLE_PAGE, AirtableTable, TokenBucket
+from calendar_request import Calendar, build_service, get_transport
+from record_model import Record
+from scheduler import TimeBudget
+from stubs import StubAirtable, StubCalendar, stub_http, synthetic_events, synthetic_table
+from sync import UNLIMITED_RATE
+from sync_script import get_active_records, update_records
+
+
+def serve(connection, size: int, changed: float, seed: int):
+    """ Runs the stand-ins loaded with a synthetic table until told to stop through `connection` """
+    records = synthetic_table(size, changed, seed)
+    with StubAirtable(records) as airtable, StubCalendar(seed=seed + 1) as gcal:
+        gcal.events.update(synthetic_events(records))
+        connection.send((airtable.url, gcal.url))
+        connection.recv()
+
+
+@contextlib.contextmanager
+def remote_stand_ins(size: int, changed: float, seed: int = 0):
+    """ Starts the stand-ins in a child process, and yields the (table, calendar) pointed at them """
+    connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve, args=(child_connection, size, changed, seed), daemon=True)
+    process.start()
+    try:
+        airtable_url, gcal_url = connection.recv()
+        table = AirtableTable('appBenchmark', 'Tasks', api_key='benchmark', api_url=airtable_url + '/v0')
+        table.writer.rate_limiter = TokenBucket(UNLIMITED_RATE, capacity=1)
+        service = build_service(get_transport(stub_http(gcal_url)))
+        yield table, Calendar('benchmark', batch=True, service=service)
+    finally:
+        connection.send('stop')
+        process.join()
+
+
+def api_pages(size: int, changed: float, seed: int = 0) -> list:
+    """ Returns the bodies of the list responses of the synthetic table's active records """
+    records = [{'id': record_id, 'fields': fields} for record_id, fields in synthetic_table(size, changed, seed).items()
+               if fields.get('lastStatus') != 'Done']
+    return [json.dumps({'records': page}).encode() for page in chunks(MAX_AIRTABLE_PAGE, records)]
+
+
+def measure_model(pages: list, parse) -> dict:
+    """ Parses every page with `parse`, and returns the memory retained by the records and the parse time """
+    start = time.perf_counter()
+    records = [record for page in pages for record in parse(page)]
+    elapsed = time.perf_counter() - start
+    del records
+
+    gc.collect()
+    tracemalloc.start()
+    records = [record for page in pages for record in parse(page)]
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {'records': len(records), 'seconds': elapsed, 'retained': retained}
+
+
+def measure_sync(size: int, changed: float, budget: bool) -> dict:
+    """ Syncs a fresh synthetic table once, and returns the peak memory allocated and the run time """
+    with remote_stand_ins(size, changed) as (table, calendar):
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            time_budget = TimeBudget(time.monotonic() + 3600, margin=0) if budget else None
+            update_records(calendar, get_active_records(table=table), table=table, budget=time_budget)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {'seconds': elapsed, 'peak': peak}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, nargs='+', default=[10000, 50000])
+    parser.add_argument('--changed', type=float, default=0.2, help='fraction of records needing a sync')
+    args = parser.parse_args()
+
+    parsers = {
+        'json dicts': lambda page: json.loads(page)['records'],
+        'records': lambda page: [Record.from_api(record) for record in record_model.loads(page)['records']],
+    }
+    print('model (%s)' % ('orjson' if record_model.orjson else 'json'))
+    print('%8s %12s %12s %10s %10s' % ('records', 'as', 'retained MB', 'B/record', 'parse s'))
+    for size in args.records:
+        pages = api_pages(size, args.changed)
+        for name, parse in parsers.items():
+            result = measure_model(pages, parse)
+            print('%8d %12s %12.1f %10.0f %10.3f' % (
+                result['records'], name, result['retained'] / 2 ** 20, result['retained'] / result['records'],
+                result['seconds']))
+
+    print('\nsync')
+    print('%8s %8s %10s %9s %10s' % ('records', 'budget', 'rec/s', 'seconds', 'peak MB'))
+    for size in args.records:
+        for budget in (False, True):
+            result = measure_sync(size, args.changed, budget)
+            print('%8d %8s %10.0f %9.2f %10.1f' % (
+                size, 'on' if budget else 'off', size / result['seconds'], result['seconds'], result['peak'] / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
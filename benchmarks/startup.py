@@ -0,0 +1,85 @@
+""" startup.py
+
+Benchmarks cold and warm latency of :func:`lambda_function.lambda_handler`.
+
+Each cold sample runs in a fresh interpreter and includes importing the handler module, like a
+Lambda cold start. Warm samples call the handler again in the same interpreter. Airtable returns
+no active records, so only the startup path (imports, credentials, Calendar service) is measured,
+without any network access.
+
+Usage:
+    python benchmarks/startup.py [--samples 5] [--warm 20]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import lambda_function, sync_script
+sync_script.get_active_records = lambda *args, **kwargs: iter(())
+lambda_function.lambda_handler({}, None)
+cold = time.perf_counter() - start
+warm = []
+for _ in range(%d):
+    start = time.perf_counter()
+    lambda_function.lambda_handler({}, None)
+    warm.append(time.perf_counter() - start)
+print(json.dumps({"cold": cold, "warm": warm}), file=sys.stderr)
+'''
+
+
+def write_service_account(path: str):
+    """ Writes throwaway service account credentials, so no real account is needed """
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption()).decode()
+    with open(path, 'w') as credentials_file:
+        json.dump({
+            'type': 'service_account',
+            'client_email': 'benchmark@example.iam.gserviceaccount.com',
+            'private_key': pem,
+            'private_key_id': 'benchmark',
+            'token_uri': 'https://oauth2.googleapis.com/token',
+        }, credentials_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', type=int, default=5, help='number of cold starts')
+    parser.add_argument('--warm', type=int, default=20, help='number of warm invocations per cold start')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        credentials_path = os.path.join(directory, 'service-account-credentials.json')
+        write_service_account(credentials_path)
+        env = dict(os.environ, AIRTABLE_API_KEY='benchmark', CALENDAR_ID='benchmark',
+                   SERVICE_ACCOUNT_FILE=credentials_path, PYTHONPATH=SRC)
+        env.pop('SYNC_STATE_PATH', None)
+        env.pop('SYNC_STATE_BUCKET', None)
+        env.pop('SNAPSHOT_CACHE_PATH', None)
+
+        cold, warm = [], []
+        for _ in range(args.samples):
+            result = subprocess.run([sys.executable, '-c', CHILD % args.warm], cwd=directory, env=env,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True, text=True)
+            timings = json.loads(result.stderr.strip().splitlines()[-1])
+            cold.append(timings['cold'])
+            warm.extend(timings['warm'])
+
+    print('cold start: median %8.2f ms  max %8.2f ms' % (statistics.median(cold) * 1000, max(cold) * 1000))
+    print('warm call:  median %8.2f ms  max %8.2f ms' % (statistics.median(warm) * 1000, max(warm) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,469 @@
+""" stubs.py
+
+This module provides local stand-ins for the Airtable REST API and the Google Calendar v3 API,
+used by the benchmarks. Both simulate latency and rate limits (429s), gzip their responses as the
+real APIs do, and count the requests and bytes they serve. They can also inject transient faults
+(5xx, 429s with `Retry-After`, dropped connections) at a given rate.
+"""
+import bisect
+import email.parser
+import gzip
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import date, timedelta
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+
+
+class StubServer:
+    """ Threaded local HTTP server that simulates latency and a requests-per-second rate limit
+
+    Subclasses implement :meth:`handle`. Requests over the rate limit are answered with a 429,
+    and a fraction `error_rate` of the requests fail with a random transient fault.
+
+    Attributes:
+        latency: Seconds each request takes to be answered
+        rate_limit: Requests accepted per rolling second (None for unlimited)
+        error_rate: Fraction of the requests answered with a fault
+        requests: Number of requests answered (including 429s)
+        rate_limited: Number of requests answered with a 429
+        faults: Number of injected faults
+        bytes_received: Size of the request bodies received
+        bytes_sent: Size of the (possibly gzipped) response bodies sent
+        url: Base url of the running server
+    """
+    gzip_user_agent = False  # whether the user agent must also contain "gzip" for a gzipped response
+
+    FAULTS = ('503', '500', '502', '429', 'drop')
+
+    def __init__(self, latency: float = 0.0, rate_limit: float = None, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.requests = 0
+        self.rate_limited = 0
+        self.faults = 0
+        self._random = random.Random(seed)
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self._recent = deque()
+        self._lock = threading.Lock()
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _dispatch(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                status, response_headers, response_body = stub._respond(self.command, self.path, self.headers, body)
+                if status is None:
+                    self.close_connection = True  # dropped connection: no response at all
+                    return
+                if response_body and stub._accepts_gzip(self.headers):
+                    response_body = gzip.compress(response_body)
+                    response_headers = dict(response_headers, **{'Content-Encoding': 'gzip'})
+                with stub._lock:
+                    stub.bytes_received += len(body)
+                    stub.bytes_sent += len(response_body)
+                self.send_response(status)
+                for key, value in response_headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(response_body)))
+                self.end_headers()
+                self.wfile.write(response_body)
+
+            do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = _dispatch
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counters(self):
+        """ Zeroes the request and byte counters """
+        with self._lock:
+            self.requests = self.rate_limited = self.faults = self.bytes_received = self.bytes_sent = 0
+
+    def _over_rate_limit(self) -> bool:
+        """ Records a request against the rolling one-second window """
+        with self._lock:
+            self.requests += 1
+            if self.rate_limit is None:
+                return False
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] >= 1:
+                self._recent.popleft()
+            if len(self._recent) >= self.rate_limit:
+                self.rate_limited += 1
+                return True
+            self._recent.append(now)
+            return False
+
+    def _accepts_gzip(self, headers) -> bool:
+        if 'gzip' not in (headers.get('Accept-Encoding') or ''):
+            return False
+        return not self.gzip_user_agent or 'gzip' in (headers.get('User-Agent') or '')
+
+    def _respond(self, method, path, headers, body):
+        over_rate_limit = self._over_rate_limit()
+        time.sleep(self.latency)
+        if over_rate_limit:
+            return 429, {'Content-Type': 'application/json'}, b'{"errors": [{"error": "RATE_LIMIT_REACHED"}]}'
+        fault = self._fault()
+        if fault == 'drop':
+            return None, {}, b''
+        if fault:
+            return self._fault_response(fault)
+        return self.handle(method, path, headers, body)
+
+    def _fault(self):
+        """ Picks the fault to inject into a request (or call of a batch), if any """
+        with self._lock:
+            if not self.error_rate or self._random.random() >= self.error_rate:
+                return None
+            self.faults += 1
+            return self._random.choice(self.FAULTS)
+
+    def _fault_response(self, fault: str) -> tuple:
+        headers = {'Content-Type': 'application/json'}
+        if fault == '429':
+            headers['Retry-After'] = '1'
+        return int(fault), headers, json.dumps({'error': {'code': int(fault), 'message': 'Injected fault'}}).encode()
+
+    def handle(self, method, path, headers, body):
+        raise NotImplementedError
+
+
+def json_response(status: int, body) -> tuple:
+    return status, {'Content-Type': 'application/json'}, json.dumps(body).encode()
+
+
+def parse_fields(fields: str) -> dict:
+    """ Parses a Google partial response `fields` selector (e.g. "a,b/c,d(e,f)") into a nested dict """
+    selector = dict()
+    stack = [selector]
+    path = []
+    name = ''
+    for char in fields + ',':
+        if char in ',/()':
+            if name:
+                path.append(name)
+                name = ''
+            if char == '/':
+                continue
+            node = stack[-1]
+            for part in path:
+                node = node.setdefault(part, dict())
+            if char == '(':
+                stack.append(node)
+            elif char == ')':
+                stack.pop()
+            path = []
+        else:
+            name += char.strip()
+    return selector
+
+
+def project(resource, selector: dict):
+    """ Keeps only the parts of a resource (or list of resources) matched by a :func:`parse_fields` selector """
+    if not selector:
+        return resource
+    if isinstance(resource, list):
+        return [project(item, selector) for item in resource]
+    if not isinstance(resource, dict):
+        return resource
+    return {key: project(resource[key], sub_selector) for key, sub_selector in selector.items() if key in resource}
+
+
+class StubAirtable(StubServer):
+    """ Airtable stand-in holding a single in-memory table
+
+    GET lists the active records (Deadline set, lastStatus not Done) in `pageSize` pages with an
+    `offset` cursor (the last record id served, so records leaving the list mid-iteration do not
+    shift the pages), ignoring `filterByFormula`. PATCH updates the fields of existing records, and
+    POST creates records.
+
+    Attributes:
+        records: Dict mapping record ids to their fields
+    """
+    def __init__(self, records: dict = None, latency: float = 0.0, rate_limit: float = None,
+                 error_rate: float = 0.0, seed: int = 0):
+        super().__init__(latency, rate_limit, error_rate, seed)
+        self.records = records if records is not None else dict()
+        self._ids = itertools.count()
+        self._sorted_ids = []
+
+    def handle(self, method, path, headers, body):
+        if method == 'GET':
+            query = parse_qs(urlparse(path).query)
+            page_size = int(query.get('pageSize', ['100'])[0])
+            offset = query.get('offset', [''])[0]
+            page = []
+            more = False
+            with self._lock:
+                if len(self._sorted_ids) != len(self.records):
+                    self._sorted_ids = sorted(self.records)
+                ids = self._sorted_ids
+                for record_id in itertools.islice(ids, bisect.bisect_right(ids, offset), None):
+                    fields = self.records[record_id]
+                    if fields.get('Deadline') and fields.get('lastStatus') != 'Done':
+                        if len(page) == page_size:
+                            more = True
+                            break
+                        page.append((record_id, dict(fields)))
+            response = {'records': [{'id': record_id, 'fields': fields} for record_id, fields in page]}
+            if more:
+                response['offset'] = page[-1][0]
+            return json_response(200, response)
+
+        payload = json.loads(body or b'{}')
+        written = []
+        with self._lock:
+            for record in payload.get('records', []):
+                record_id = record.get('id') or 'recNew%011d' % next(self._ids)
+                self.records.setdefault(record_id, dict()).update(record.get('fields', {}))
+                written.append({'id': record_id, 'fields': self.records[record_id]})
+        return json_response(200, {'records': written})
+
+
+class StubCalendar(StubServer):
+    """ Google Calendar v3 stand-in holding a single calendar's events in memory
+
+    Supports events insert, patch, delete, get and list (with `pageToken` and `syncToken`), and the
+    multipart/mixed batch endpoint, with `fields` partial responses and `If-Match`/`If-None-Match`
+    conditional requests. Like Google, responses are
+    only gzipped for user agents containing "gzip". Faults are injected into the calls of a batch
+    as well as into whole requests. Use :meth:`http` to point a googleapiclient service at it.
+
+    Attributes:
+        events: Dict mapping event ids to event resources
+        batched: Number of calls received inside batch requests
+    """
+    EVENT_PATH = re.compile(r'/calendar/v3/calendars/[^/]+/events(?:/([^/?]+))?')
+    gzip_user_agent = True
+
+    def __init__(self, latency: float = 0.0, rate_limit: float = None, error_rate: float = 0.0, seed: int = 0):
+        super().__init__(latency, rate_limit, error_rate, seed)
+        self.events = dict()
+        self.batched = 0
+        self._versions = itertools.count(1)
+
+    def http(self) -> httplib2.Http:
+        """ Returns an httplib2 client that sends every googleapis.com request to this stub """
+        return stub_http(self.url)
+
+    def _event_resource(self, event_id: str, event: dict) -> dict:
+        return event_resource(event_id, event, next(self._versions))
+
+    def handle(self, method, path, headers, body):
+        if path.startswith('/batch/'):
+            return self._handle_batch(headers, body)
+
+        status, response_headers, response_body = self._handle_events(method, path, headers, body)
+        fields = parse_qs(urlparse(path).query).get('fields')
+        if fields and status == 200:
+            response_body = json.dumps(project(json.loads(response_body), parse_fields(fields[0]))).encode()
+        return status, response_headers, response_body
+
+    def _handle_events(self, method, path, headers, body):
+        match = self.EVENT_PATH.match(urlparse(path).path)
+        if not match:
+            return json_response(404, {'error': {'code': 404, 'message': 'Not Found'}})
+        event_id = match.group(1)
+        query = parse_qs(urlparse(path).query)
+
+        with self._lock:
+            if method == 'POST' and event_id is None:
+                event = json.loads(body)
+                event_id = event.pop('id', None) or uuid.uuid4().hex
+                if event_id in self.events:
+                    return json_response(409, {'error': {'code': 409, 'message': 'The requested identifier already exists.'}})
+                self.events[event_id] = self._event_resource(event_id, event)
+                return json_response(200, self.events[event_id])
+            if method == 'GET' and event_id is None:
+                return self._list(query)
+            if event_id not in self.events:
+                return json_response(404, {'error': {'code': 404, 'message': 'Not Found'}})
+            etag = self.events[event_id]['etag']
+            if method == 'GET' and headers.get('If-None-Match') == etag:
+                return 304, {}, b''
+            if method != 'GET' and headers.get('If-Match') not in (None, etag):
+                return json_response(412, {'error': {'code': 412, 'message': 'Precondition Failed'}})
+            if method == 'DELETE':
+                # like Gcal, deleted events are kept as cancelled, and their id stays taken
+                self.events[event_id] = self._event_resource(event_id, dict(self.events[event_id], status='cancelled'))
+                return 204, {'Content-Type': 'application/json'}, b''
+            if method == 'PATCH':
+                self.events[event_id] = self._event_resource(event_id, dict(self.events[event_id], **json.loads(body)))
+            return json_response(200, self.events[event_id])
+
+    def _list(self, query: dict) -> tuple:
+        events = sorted(self.events.values(), key=lambda event: int(event['updated']))
+        if 'syncToken' in query:
+            since = int(query['syncToken'][0])
+            events = [event for event in events if int(event['updated']) > since]
+        elif query.get('showDeleted') != ['true']:
+            events = [event for event in events if event['status'] != 'cancelled']
+        offset = int(query.get('pageToken', ['0'])[0])
+        page_size = int(query.get('maxResults', ['250'])[0])
+        response = {'kind': 'calendar#events', 'items': events[offset:offset + page_size]}
+        if offset + page_size < len(events):
+            response['nextPageToken'] = str(offset + page_size)
+        else:
+            response['nextSyncToken'] = str(max([int(event['updated']) for event in self.events.values()] or [0]))
+        return json_response(200, response)
+
+    def _handle_batch(self, headers, body) -> tuple:
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+        responses = []
+        for part in message.get_payload():
+            request_line, _, rest = part.get_payload().partition('\n')
+            method, path, _ = request_line.strip().split(' ')
+            inner_head, inner_body = (re.split(r'\r?\n\r?\n', rest, maxsplit=1) + [''])[:2]
+            inner_headers = email.parser.Parser().parsestr(inner_head, headersonly=True)
+            fault = self._fault()
+            if fault is None:
+                status, _, response_body = self.handle(method, path, inner_headers, inner_body.strip().encode())
+            else:
+                # a single call of a batch cannot drop the connection
+                status, _, response_body = self._fault_response('503' if fault == 'drop' else fault)
+            self.batched += 1
+            responses.append('Content-Type: application/http\r\nContent-ID: <response-%s\r\n\r\n'
+                             'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n\r\n%s\r\n'
+                             % (part['Content-ID'].lstrip('<'), status, HTTPStatus(status).phrase,
+                                response_body.decode()))
+
+        boundary = 'batch_' + uuid.uuid4().hex
+        response = ''.join('--%s\r\n%s' % (boundary, part) for part in responses) + '--%s--\r\n' % boundary
+        return 200, {'Content-Type': 'multipart/mixed; boundary=' + boundary}, response.encode()
+
+
+def stub_http(stub_url: str) -> httplib2.Http:
+    """ Returns an httplib2 client that sends every googleapis.com request to the :obj:`StubCalendar` at `stub_url` """
+    class StubHttp(httplib2.Http):
+        def request(self, uri, *args, **kwargs):
+            return super().request(uri.replace('https://www.googleapis.com', stub_url), *args, **kwargs)
+
+    return StubHttp()
+
+
+def event_resource(event_id: str, event: dict, version: int) -> dict:
+    """ Completes an event body into a full Gcal event resource, as returned without `fields` """
+    return dict({'status': 'confirmed'}, **dict(event, **{
+        'kind': 'calendar#event', 'id': event_id, 'etag': '"%d"' % version,
+        'updated': '%d' % version, 'created': '2021-01-01T00:00:00.000Z', 'eventType': 'default',
+        'htmlLink': 'https://www.google.com/calendar/event?eid=' + event_id, 'iCalUID': event_id + '@google.com',
+        'creator': {'email': 'benchmark@example.iam.gserviceaccount.com'},
+        'organizer': {'email': 'benchmark@group.calendar.google.com', 'displayName': 'Airtable Tasks', 'self': True},
+        'reminders': {'useDefault': True}, 'sequence': 0,
+    }))
+
+
+def synthetic_table(size: int, changed: float = 0.2, seed: int = 0) -> dict:
+    """ Generates the fields of an Airtable tasks table, for :obj:`StubAirtable`
+
+    About `changed` of the records need a sync, spread evenly over new records, renames, deadline
+    moves, and Done transitions; the rest are already in sync.
+
+    Args:
+        size: Number of records
+        changed: Fraction of records that need a sync
+        seed: Random seed
+
+    Returns:
+        Dict mapping record ids to their fields
+    """
+    generator = random.Random(seed)
+    today = date.today()
+    records = dict()
+    for index in range(size):
+        deadline = (today + timedelta(days=generator.randint(-3, 60))).isoformat()
+        fields = {
+            'Name': 'Task %d' % index, 'lastName': 'Task %d' % index, 'Status': 'Todo',
+            'Deadline': deadline, 'lastDeadline': deadline, 'calendarEventId': 'event%d' % index,
+            'duration': 1, 'Deadline Group': 'Backlog',
+        }
+        if generator.random() < changed:
+            change = generator.choice(['new', 'rename', 'move', 'done'])
+            if change == 'new':
+                for field in ('lastName', 'lastDeadline', 'calendarEventId', 'duration', 'Deadline Group'):
+                    del fields[field]
+            elif change == 'rename':
+                fields['Name'] += ' (renamed)'
+            elif change == 'move':
+                fields['Deadline'] = (today + timedelta(days=generator.randint(0, 60))).isoformat()
+            else:
+                fields['Status'] = 'Done'
+        records['rec%014d' % index] = fields
+    return records
+
+
+def synthetic_events(records: dict) -> dict:
+    """ Generates the Gcal events matching the records of :func:`synthetic_table` that already have one """
+    events = dict()
+    for record_id, fields in records.items():
+        if fields.get('calendarEventId'):
+            events[fields['calendarEventId']] = event_resource(fields['calendarEventId'], {
+                'summary': fields['lastName'], 'description': record_id + ' s3',
+                'start': {'dateTime': fields['lastDeadline'] + 'T16:00:00Z', 'timeZone': 'UTC'},
+                'end': {'dateTime': fields['lastDeadline'] + 'T17:00:00Z', 'timeZone': 'UTC'},
+            }, version=0)
+    return events
+
+
+def historical_table(size: int, done: float = 0.8, seed: int = 0) -> dict:
+    """ Generates the fields of a table that was never synced, for :obj:`StubAirtable`
+
+    Args:
+        size: Number of records
+        done: Fraction of the records already "Done"
+        seed: Random seed
+
+    Returns:
+        Dict mapping record ids to their fields
+    """
+    generator = random.Random(seed)
+    today = date.today()
+    return {'rec%014d' % index: {
+        'Name': 'Task %d' % index, 'Status': 'Done' if generator.random() < done else 'Todo',
+        'Deadline': (today + timedelta(days=generator.randint(-365, 60))).isoformat(),
+    } for index in range(size)}
+
+
+def untagged_events(size: int, seed: int = 0) -> dict:
+    """ Generates events created directly in Gcal (not by the sync), for :obj:`StubCalendar` """
+    generator = random.Random(seed)
+    today = date.today()
+    events = dict()
+    for index in range(size):
+        day = (today + timedelta(days=generator.randint(-365, 60))).isoformat()
+        hour = generator.randint(8, 18)
+        events['gcal%06d' % index] = event_resource('gcal%06d' % index, {
+            'summary': 'Meeting %d' % index, 'description': 'Agenda of meeting %d' % index,
+            'start': {'dateTime': '%sT%02d:00:00Z' % (day, hour), 'timeZone': 'UTC'},
+            'end': {'dateTime': '%sT%02d:30:00Z' % (day, hour + 1), 'timeZone': 'UTC'},
+        }, version=0)
+    return events
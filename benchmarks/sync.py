@@ -0,0 +1,103 @@
+""" sync.py
+
+Benchmarks :func:`sync_script.update_records` against the local Airtable and Google Calendar
+stand-ins of :mod:`stubs`, loaded with a synthetic table.
+
+Reports records/sec, API calls per record, p50/p99 run latency and (with --memory) the peak
+Python memory allocated during a run.
+
+Usage:
+    python benchmarks/sync.py [--records 1000 10000] [--changed 0.2] [--runs 5] [--latency 0]
+                              [--rate-limit 5] [--memory]
+"""
+import argparse
+import contextlib
+import io
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault('AIRTABLE_API_KEY', 'benchmark')
+
+from airtable_request import AirtableTable, TokenBucket
+from calendar_request import Calendar, build_service, get_transport
+from stubs import StubAirtable, StubCalendar, synthetic_events, synthetic_table
+from sync_script import get_active_records, update_records
+
+UNLIMITED_RATE = 1e9
+
+
+@contextlib.contextmanager
+def stand_ins(size: int, changed: float, latency: float, rate_limit: float, seed: int = 0, error_rate: float = 0.0):
+    """ Starts the stand-ins loaded with a synthetic table, and yields (table, calendar, airtable stub, gcal stub) """
+    records = synthetic_table(size, changed, seed)
+    with StubAirtable(records, latency, rate_limit, error_rate, seed) as airtable, \
+            StubCalendar(latency, error_rate=error_rate, seed=seed + 1) as gcal:
+        gcal.events.update(synthetic_events(records))
+        table = AirtableTable('appBenchmark', 'Tasks', api_key='benchmark', api_url=airtable.url + '/v0')
+        table.writer.rate_limiter = TokenBucket(0.9 * rate_limit if rate_limit else UNLIMITED_RATE, capacity=1)
+        service = build_service(get_transport(gcal.http()))
+        calendar = Calendar('benchmark', batch=True, service=service)
+        yield table, calendar, airtable, gcal
+
+
+def run(size: int, changed: float, latency: float, rate_limit: float, seed: int, memory: bool = False) -> dict:
+    """ Syncs a fresh synthetic table once and returns the measurements """
+    with stand_ins(size, changed, latency, rate_limit, seed) as (table, calendar, airtable, gcal):
+        if memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            failed = update_records(calendar, get_active_records(table=table), table=table)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if memory else None
+        if memory:
+            tracemalloc.stop()
+
+        return {
+            'seconds': elapsed,
+            'airtable_calls': airtable.requests,
+            'gcal_calls': gcal.requests,
+            'gcal_batched': gcal.batched,
+            'rate_limited': airtable.rate_limited + gcal.rate_limited,
+            'bytes': airtable.bytes_received + airtable.bytes_sent + gcal.bytes_received + gcal.bytes_sent,
+            'failed': sum(len(payload['records']) for payload, _ in failed),
+            'peak_memory': peak,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--changed', type=float, default=0.2, help='fraction of records needing a sync')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per API request')
+    parser.add_argument('--rate-limit', type=float, default=None, help='Airtable requests/second (default unlimited)')
+    parser.add_argument('--memory', action='store_true', help='also measure peak memory (one extra run)')
+    args = parser.parse_args()
+
+    print('%8s %10s %10s %9s %9s %9s %9s %6s %7s %10s' % (
+        'records', 'rec/s', 'calls/rec', 'p50 s', 'p99 s', 'at calls', 'gcal', '429s', 'failed', 'peak MB'))
+    for size in args.records:
+        results = [run(size, args.changed, args.latency, args.rate_limit, seed) for seed in range(args.runs)]
+        durations = sorted(result['seconds'] for result in results)
+        p99 = durations[min(len(durations) - 1, int(round(0.99 * (len(durations) - 1))))]
+        last = results[-1]
+        peak = '-'
+        if args.memory:
+            peak = '%.1f' % (run(size, args.changed, args.latency, args.rate_limit, 0, memory=True)['peak_memory'] / 2 ** 20)
+
+        print('%8d %10.0f %10.3f %9.3f %9.3f %9d %9d %6d %7d %10s' % (
+            size, size / statistics.median(durations),
+            (last['airtable_calls'] + last['gcal_calls']) / size,
+            statistics.median(durations), p99,
+            last['airtable_calls'], last['gcal_calls'],
+            sum(result['rate_limited'] for result in results),
+            sum(result['failed'] for result in results), peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+""" wire.py
+
+Benchmarks the bytes on the wire per synced record against the local Airtable and Google Calendar
+stand-ins of :mod:`stubs`, with and without the transport optimizations: gzip responses and
+`fields` partial responses on every Gcal call.
+
+A run lists the calendar changes and syncs a fresh synthetic table, like :func:`sync_script.sync`.
+
+Usage:
+    python benchmarks/wire.py [--records 1000 10000] [--changed 0.2]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+os.environ.setdefault('AIRTABLE_API_KEY', 'benchmark')
+
+import calendar_request
+from state_store import StateStore
+from sync import stand_ins
+from sync_script import get_active_records, index_calendar_changes, update_records
+
+
+@contextlib.contextmanager
+def plain_transport(table, calendar, gcal):
+    """ Disables gzip and partial responses, as before the transport optimizations """
+    table.session.headers['Accept-Encoding'] = 'identity'
+    calendar.service = calendar_request.build_service(gcal.http())
+    with mock.patch.multiple(calendar_request, EVENT_FIELDS=None, WRITE_FIELDS=None, CHANGES_FIELDS=None, LIST_FIELDS=None):
+        yield
+
+
+def run(size: int, changed: float, optimized: bool) -> dict:
+    """ Syncs a fresh synthetic table once and returns the bytes exchanged with each API """
+    with stand_ins(size, changed, latency=0.0, rate_limit=None) as (table, calendar, airtable, gcal):
+        transport = contextlib.nullcontext() if optimized else plain_transport(table, calendar, gcal)
+        with transport, contextlib.redirect_stdout(io.StringIO()):
+            calendar_changes = index_calendar_changes(calendar.list_changes(StateStore()))
+            update_records(calendar, get_active_records(table=table), calendar_changes, table=table)
+
+        return {
+            'airtable': airtable.bytes_received + airtable.bytes_sent,
+            'gcal': gcal.bytes_received + gcal.bytes_sent,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--changed', type=float, default=0.2, help='fraction of records needing a sync')
+    args = parser.parse_args()
+
+    print('%8s %10s %12s %12s %12s %9s' % ('records', 'transport', 'at B/rec', 'gcal B/rec', 'total B/rec', 'saved'))
+    for size in args.records:
+        before = run(size, args.changed, optimized=False)
+        after = run(size, args.changed, optimized=True)
+        for name, result in (('plain', before), ('optimized', after)):
+            total = result['airtable'] + result['gcal']
+            saved = 1 - total / (before['airtable'] + before['gcal'])
+            print('%8d %10s %12.0f %12.0f %12.0f %8.0f%%' % (
+                size, name, result['airtable'] / size, result['gcal'] / size, total / size, 100 * saved))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,52 +3,310 @@
 This module abstracts and accounts for paging when sending requests to the Airtable API
 """
 import os
+import threading
+import time
 import requests
-from funcy import get_in, partial
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from funcy import get_in, memoize, partial
 from dotenv import load_dotenv
-from typing import Dict
+from typing import Callable, Dict, Iterator, List, Optional
+
+from http_client import CONNECTION_ERRORS, CircuitOpenError, ResilientSession, Retrier
+from metrics import metrics
+from record_model import dumps, loads
 
 # load env variables
 load_dotenv()
 AIRTABLE_API_KEY = os.getenv('AIRTABLE_API_KEY')
+AIRTABLE_API_URL = os.getenv('AIRTABLE_API_URL', 'https://api.airtable.com/v0')
 BASE_NAME = os.getenv('BASE_NAME')
 TABLE_NAME = os.getenv('TABLE_NAME')
 MAX_AIRTABLE_PATCH = 10
+MAX_AIRTABLE_PAGE = 100
+AIRTABLE_RATE_LIMIT = 5  # requests per second, per base
+AIRTABLE_TARGET_RATE = 0.9 * AIRTABLE_RATE_LIMIT  # headroom for network jitter
+AIRTABLE_RATE_LIMIT_PENALTY = 30  # seconds Airtable blocks a base after a 429
+MAX_IN_FLIGHT = 4
+
+URL_TEMPLATE = '{0}/{1}/{2}'
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+class TokenBucket:
+    """ Thread-safe token bucket used to stay under a requests-per-second rate limit
+
+    Attributes:
+        rate: Tokens added per second
+        capacity: Maximum number of tokens that can be saved up for a burst
+    """
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Blocks until a token is available, then consumes it """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+class AirtableWriter:
+    """ Sends Airtable write requests concurrently, within the base's rate limit
+
+    Up to `max_in_flight` requests are sent at once. `request` is expected to retry transient
+    failures and wait on the base's :obj:`TokenBucket` (see :obj:`AirtableTable`). A request
+    that Airtable rejects as a whole (e.g. one record was deleted, or has an invalid value) is
+    retried one record at a time, so the failure is narrowed down to the offending records.
+
+    Payloads are serialized straight to bytes (see :func:`record_model.dumps`), and completed
+    requests are forgotten as new ones are submitted, so a long run does not hold on to every
+    response until :meth:`wait`.
+
+    Attributes:
+        request: Callable with the signature of :func:`requests.request`, bound to the table url
+        rate_limiter: The :obj:`TokenBucket` shared by all requests of this writer
+        failed: Payloads that could not be written, along with the final error
+    """
+    def __init__(self, request: Callable, rate_limiter: Optional[TokenBucket] = None,
+                 max_in_flight: int = MAX_IN_FLIGHT):
+        self.request = request
+        self.rate_limiter = rate_limiter or TokenBucket(AIRTABLE_TARGET_RATE, capacity=1)
+        self.failed = []
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._futures = []
+
+    def _send(self, request_type: str, payload: dict) -> Optional[requests.Response]:
+        """ Sends one request, splitting it up per record if Airtable rejects it """
+        response = None
+        try:
+            with metrics.timer('airtable.' + request_type):
+                response = self.request(request_type, data=dumps(payload), headers=JSON_HEADERS)
+            metrics.count('airtable.requests')
+            metrics.count('airtable.request_bytes', len(response.request.body or b''))
+            error = None if response.status_code < 400 else requests.HTTPError(
+                '%s %s' % (response.status_code, response.text[:200]), response=response)
+        except (CircuitOpenError, *CONNECTION_ERRORS) as send_error:
+            error = send_error
+
+        if error is None:
+            metrics.count('airtable.records_written', len(payload['records']))
+            return response
+        if response is not None and response.status_code in (404, 422) and len(payload['records']) > 1:
+            metrics.count('airtable.split_requests')
+            for record in payload['records']:
+                self._send(request_type, dict(payload, records=[record]))
+            return None
+
+        print('Airtable %s failed for %d records: %s' % (request_type, len(payload['records']), error))
+        metrics.count('airtable.records_failed', len(payload['records']))
+        self.failed.append((payload, error))
+        return None
+
+    def submit(self, request_type: str, payload: dict) -> Future:
+        """ Schedules a request to be sent
+
+        Args:
+            request_type: String denoting what type of request ("post", "patch") etc
+            payload: Airtable API-friendly dictionary with contents of request
+
+        Returns:
+            Future resolving to the final response, or None if the request failed
+        """
+        future = self._executor.submit(self._send, request_type, payload)
+        self._futures = [pending for pending in self._futures if not pending.done()]
+        self._futures.append(future)
+        return future
+
+    def drain_time(self, unsubmitted: int = 0) -> float:
+        """ Estimated seconds until every submitted request, and `unsubmitted` more, are sent given the rate limit """
+        backlog = sum(not future.done() for future in self._futures)
+        return (backlog + unsubmitted) / self.rate_limiter.rate
+
+    def wait(self) -> List:
+        """ Blocks until every submitted request has completed
+
+        Returns:
+            The (payload, error) pairs of the requests that failed
+        """
+        futures, self._futures = self._futures, []
+        wait(futures)
+        failed, self.failed = self.failed, []
+        return failed
+
+
+@memoize
+def get_rate_limiter(base_name: str) -> TokenBucket:
+    """ Returns the :obj:`TokenBucket` shared by every table of a base, as Airtable rate limits per base """
+    return TokenBucket(AIRTABLE_TARGET_RATE, capacity=1)
+
+
+class AirtableTable:
+    """ Connection to a single Airtable table
+
+    Each table gets its own pooled session and :obj:`AirtableWriter`, so tables can be synced
+    concurrently; writers of tables in the same base share that base's rate limiter.
+
+    Every request, read or write, waits for a token of the writer's rate limiter, and is retried
+    on transient failures (see :obj:`http_client.ResilientSession`).
+
+    Attributes:
+        base_name: Id of the Airtable base
+        table_name: Name (or id) of the table
+        url: Airtable API url of the table
+        session: Pooled keep-alive session, shared by reads and writes
+        request: :func:`requests.request`-like callable bound to the table url
+        writer: The table's :obj:`AirtableWriter`
+    """
+    def __init__(self, base_name: str, table_name: str, api_key: str = AIRTABLE_API_KEY,
+                 api_url: str = AIRTABLE_API_URL):
+        self.base_name = base_name
+        self.table_name = table_name
+        self.url = URL_TEMPLATE.format(api_url, base_name, table_name)
+        self.session = ResilientSession(Retrier('airtable', rate_limit_penalty=AIRTABLE_RATE_LIMIT_PENALTY,
+                                                throttle=self.throttle))
+        self.session.headers.update({'Authorization': "Bearer " + api_key})
+        self.request = partial(self.session.request, url=self.url)
+        self.writer = AirtableWriter(self.request, get_rate_limiter(base_name))
 
-headers = {'Authorization': "Bearer " + AIRTABLE_API_KEY}
-url = 'https://api.airtable.com/v0/{0}/{1}'.format(BASE_NAME, TABLE_NAME)
+    def throttle(self):
+        """ Waits for a token of the writer's rate limiter, before every attempt of every request """
+        self.writer.rate_limiter.acquire()
 
-airtable_request = partial(requests.request, url=url, headers=headers)
 
-def update_payload_state(payload: dict, request_type: str) -> Dict:
+@memoize
+def get_table(base_name: str, table_name: str) -> AirtableTable:
+    """ Returns the :obj:`AirtableTable` for a base and table, reused across warm invocations """
+    return AirtableTable(base_name, table_name)
+
+
+# table configured in the environment, used when no table is specified
+default_table = get_table(BASE_NAME, TABLE_NAME)
+url = default_table.url
+session = default_table.session
+airtable_request = default_table.request
+writer = default_table.writer
+
+
+def get_page(params: dict, table: Optional[AirtableTable] = None,
+             model: Optional[Callable[[Dict], object]] = None) -> Dict:
+    """ Retrieves a single page of records from the Airtable API
+
+    Reads take their token from the base's rate limiter too, so that read-heavy runs (e.g. a
+    :mod:`backfill`) stay under the rate limit along with their writes. Transient failures are
+    retried by the table's session.
+
+    The response is parsed straight from its bytes (see :func:`record_model.loads`), and with a
+    `model` each record is converted as soon as its page is parsed, so that the nested dicts of
+    the page are freed right away.
+
+    Args:
+        params: Query parameters of the list request, including the `offset` cursor if any
+        table: (optional) The :obj:`AirtableTable` to query, instead of the default table
+        model: (optional) Converts each record of the page, e.g. :meth:`record_model.Record.from_api`
+
+    Returns:
+        Dict with the response from Airtable for the get request
+    """
+    table = table or default_table
+    with metrics.timer('airtable.get_page'):
+        response = table.request('get', params=params)
+        response.raise_for_status()
+        page = loads(response.content)
+        if model:
+            page['records'] = [model(record) for record in page.get('records', [])]
+    metrics.count('airtable.requests')
+    metrics.count('airtable.response_bytes', len(response.content))
+    metrics.count('airtable.records_fetched', len(page.get('records', [])))
+    return page
+
+
+def iter_records(params: dict, table: Optional[AirtableTable] = None,
+                 model: Optional[Callable[[Dict], object]] = None) -> Iterator:
+    """ Streams the records of a list request, following Airtable's `offset` cursor
+
+    Pages of MAX_AIRTABLE_PAGE records are requested until Airtable stops returning an
+    `offset`. The next page is downloaded in the background while the records of the
+    current page are being consumed, so processing can start as soon as the first page arrives.
+
+    Args:
+        params: Query parameters of the list request (fields, filterByFormula, etc)
+        table: (optional) The :obj:`AirtableTable` to query, instead of the default table
+        model: (optional) Converts each record (see :func:`get_page`)
+
+    Yields:
+        Each record (as converted by `model`) in the order returned by Airtable
+    """
+    params = dict(params, pageSize=MAX_AIRTABLE_PAGE)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_page = executor.submit(get_page, params, table, model)
+        while next_page is not None:
+            page = next_page.result()
+            offset = page.get('offset')
+            next_page = executor.submit(get_page, dict(params, offset=offset), table, model) if offset else None
+            yield from page.get('records', [])
+
+
+def update_payload_state(payload: dict, request_type: str, table: Optional[AirtableTable] = None) -> Dict:
     """ Abstracts paging from airtable requests
 
     If the payload's record count is at the MAX_AIRTABLE_PATCH number, then
-    the method sends the request, and returns an empty payload template.
+    the method schedules the request on the :obj:`AirtableWriter`, and returns an
+    empty payload template.
 
     Args:
         payload: Airtable API-friendly dictionary with contents of request
         request_type: String denoting what type of request ("get", "post", "patch) etc
+        table: (optional) The :obj:`AirtableTable` to write to, instead of the default table
 
     Returns:
         If the payload is sent, returns an empty Airtable API-friendly payload template.
         Else, returns the inputted payload 
     """
     if len(payload['records']) >= MAX_AIRTABLE_PATCH:
-        _ = airtable_request(request_type, json=payload)
+        (table or default_table).writer.submit(request_type, payload)
         payload = {"records": [], "typecast": True}
     return payload
 
-def send_nonempty_payload(payload: dict, request_type: str):
+def send_nonempty_payload(payload: dict, request_type: str, table: Optional[AirtableTable] = None) -> List:
     """ Abstracts paging from airtable requests
 
     If the payload's record count is greater than 0, then
-    the method sends the request, and returns an empty payload template. This method is usually
-    used at the end when all records are processed.
+    the method sends the request, and waits for every scheduled request to complete. This
+    method is usually used at the end when all records are processed.
 
     Args:
         payload: Airtable API-friendly dictionary with contents of request
         request_type: String denoting what type of request ("get", "post", "patch) etc
+        table: (optional) The :obj:`AirtableTable` to write to, instead of the default table
+
+    Returns:
+        The (payload, error) pairs of the requests that failed
     """
+    table_writer = (table or default_table).writer
     if len(payload['records']) > 0:
-        _ = airtable_request(request_type, json=payload)
+        table_writer.submit(request_type, payload)
+    with metrics.timer('airtable.flush'):
+        return table_writer.wait()
+
+
+def failed_records(failed: List) -> Dict[str, Exception]:
+    """ Maps the id of every record of the failed requests to the request's error
+
+    Args:
+        failed: The (payload, error) pairs returned by :meth:`AirtableWriter.wait`
+
+    Returns:
+        Dict mapping record ids to errors
+    """
+    return {record['id']: error for payload, error in failed for record in payload['records'] if 'id' in record}
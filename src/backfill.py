@@ -0,0 +1,225 @@
+""" backfill.py
+
+This module onboards large existing tables and calendars in bulk, which the incremental sync would
+take hours (and many rate limit penalties) to get through:
+    - backfill: creates the events of every record that was never synced (no `lastDeadline`)
+    - import: creates a record for every event of the calendar that no record links to
+
+Records and events are streamed page by page. Backfilled records go through the sync rules with
+batched Gcal inserts (see :func:`sync_script.update_records`), and both directions write to
+Airtable in MAX_AIRTABLE_PATCH-record requests sent several at a time by the table's
+:obj:`airtable_request.AirtableWriter`.
+
+Progress is checkpointed in the state store every BACKFILL_CHECKPOINT records. Since both
+directions only ever pick up what is left to do, an interrupted backfill is resumed by simply
+running it again: events are created with deterministic ids (see
+:func:`calendar_request.event_id_for`), so the records whose write-back was lost are not duplicated.
+
+Usage:
+    python backfill.py [--import] [--since YYYY-MM-DD] [--until YYYY-MM-DD]
+"""
+import argparse
+import os
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, Iterator, Optional
+
+from funcy import chunks, get_in
+
+from airtable_request import MAX_AIRTABLE_PATCH, AirtableTable, default_table, get_table, iter_records
+from calendar_request import Calendar, parse_event_time, record_id_of
+from journal import Journal, get_journal
+from metrics import metrics
+from record_model import Record, loads
+from reconcile import get_linked_records
+from rule_pipeline import TODAY_OFFSET, parse_deadline
+from snapshot_cache import get_snapshot_cache
+from state_store import StateStore, get_state_store
+from sync_script import RECORD_FIELDS, load_sync_config, table_key, update_records
+
+BACKFILL_CHECKPOINT = int(os.getenv('BACKFILL_CHECKPOINT_RECORDS', 1000))
+
+
+def get_unsynced_records(table: Optional[AirtableTable] = None) -> Iterator[Record]:
+    """ Streams the records that have a `Deadline` but were never synced (no `lastDeadline`)
+
+    Unlike :func:`sync_script.get_active_records`, records whose `Status` is already "Done" are
+    included: historical tasks get their event too, created in the completed color (see
+    :func:`sync_script.process_new_record`).
+
+    Args:
+        table: (optional) The :obj:`airtable_request.AirtableTable` to query, instead of the default table
+
+    Returns:
+        Iterator over the :obj:`record_model.Record`
+    """
+    params = {"fields[]": RECORD_FIELDS,
+              "filterByFormula": "AND(NOT({Deadline}=''), {lastDeadline}='')"}
+    return iter_records(params, table, Record.from_api)
+
+
+def checkpoint(state_store: Optional[StateStore], key: str, progress: Optional[Dict]):
+    """ Saves the progress of a backfill or import, clearing it once `progress` is None """
+    if state_store:
+        state_store.set(key, progress)
+
+
+def report_progress(name: str, progress: Dict, count: int, started: float):
+    """ Prints the progress of a backfill or import, with the throughput of the current run """
+    elapsed = time.monotonic() - started
+    print(f'{name}: {progress["done"]} done, {progress["failed"]} failed '
+          f'({count / elapsed * 60 if elapsed else 0:.0f}/min)')
+
+
+def backfill(calendar: Calendar, table: Optional[AirtableTable] = None, state_store: Optional[StateStore] = None,
+             journal: Optional[Journal] = None) -> Dict:
+    """ Creates the events of every unsynced record, and writes `calendarEventId`, `lastDeadline`, etc back
+
+    The records are run through the sync rules BACKFILL_CHECKPOINT at a time, so they end up
+    exactly as if the regular sync had processed them one run at a time.
+
+    Args:
+        calendar: The :obj:`calendar_request.Calendar` of the table, in batched mode
+        table: (optional) The :obj:`airtable_request.AirtableTable` to backfill, instead of the default table
+        state_store: (optional) The :obj:`state_store.StateStore` holding the checkpoints
+        journal: (optional) The :obj:`journal.Journal` of the pending Airtable updates
+
+    Returns:
+        Dict with the number of records "done" and "failed", over every run of this backfill
+    """
+    table = table or default_table
+    key = table_key(table) + ':backfill'
+    progress = (state_store.get(key) if state_store else None) or {"done": 0, "failed": 0}
+    if progress["done"]:
+        print(f'Resuming the backfill of {table_key(table)} after {progress["done"]} records')
+
+    started = time.monotonic()
+    count = 0
+    for records in chunks(BACKFILL_CHECKPOINT, get_unsynced_records(table)):
+        with metrics.timer('backfill.update_records'):
+            failed = update_records(calendar, records, table=table, journal=journal)
+        failed_count = sum(len(payload['records']) for payload, _ in failed)
+        count += len(records)
+        progress = {"done": progress["done"] + len(records) - failed_count,
+                    "failed": progress["failed"] + failed_count}
+        checkpoint(state_store, key, progress)
+        report_progress(f'Backfill of {table_key(table)}', progress, count, started)
+
+    metrics.count('backfill.records', count)
+    checkpoint(state_store, key, None)
+    return progress
+
+
+def event_record_fields(event: Dict, today) -> Dict:
+    """ Airtable fields of the record imported from an event, as if the sync had already processed it
+
+    Args:
+        event: A timed (not all-day) event, as returned by :meth:`calendar_request.Calendar.list_events`
+        today: The current date, as seen by the "Today" deadline group
+
+    Returns:
+        Dict of the record fields
+    """
+    start = get_in(event, ['start', 'dateTime'])
+    end = get_in(event, ['end', 'dateTime'])
+    deadline = parse_event_time(start).date().isoformat()  # in UTC, whatever the offset Gcal lists it with
+    _, deadline_group, day, is_today = parse_deadline(deadline, today)
+    hours = (parse_event_time(end) - parse_event_time(start)).total_seconds() / 3600 if end else 0
+    name = event.get('summary') or ''
+    return {
+        "Name": name,
+        "lastName": name,
+        "Deadline": deadline,
+        "lastDeadline": deadline,
+        "lastCalendarDeadline": start,
+        "calendarEventId": event['id'],
+        "duration": hours or 1,
+        "Deadline Group": "Today" if is_today else deadline_group,
+        "Day": day,
+    }
+
+
+def import_events(calendar: Calendar, table: Optional[AirtableTable] = None,
+                  state_store: Optional[StateStore] = None, time_min: Optional[datetime] = None,
+                  time_max: Optional[datetime] = None) -> Dict:
+    """ Creates a record for every event of the calendar that no record links to
+
+    Events already linked (by a record's `calendarEventId`) or tagged with a record id are
+    skipped, as are all-day events. The records are POSTed MAX_AIRTABLE_PATCH at a time, and
+    each event is then tagged with its new record id (see
+    :meth:`calendar_request.Calendar.patch_event`), so that moving it in Gcal moves the record's
+    `Deadline` too. The tag is a private extended property: the event's description is left as is.
+
+    Args:
+        calendar: The :obj:`calendar_request.Calendar` to import, in batched mode
+        table: (optional) The :obj:`airtable_request.AirtableTable` to import into, instead of the default table
+        state_store: (optional) The :obj:`state_store.StateStore` holding the checkpoints
+        time_min: (optional) Only import events ending after this (UTC) time
+        time_max: (optional) Only import events starting before this (UTC) time
+
+    Returns:
+        Dict with the number of events "done" and "failed", over every run of this import
+    """
+    table = table or default_table
+    key = table_key(table) + ':import'
+    progress = (state_store.get(key) if state_store else None) or {"done": 0, "failed": 0}
+    if progress["done"]:
+        print(f'Resuming the import into {table_key(table)} after {progress["done"]} events')
+
+    with metrics.timer('backfill.linked_records'):
+        linked_event_ids = {record['fields'].get("calendarEventId") for record in get_linked_records(table)}
+    today = (datetime.today() - TODAY_OFFSET).date()
+    in_flight = deque()  # (future of the POST, its events), in submission order
+
+    def tag_events(block: bool):
+        # tag the events of the completed POSTs, oldest first
+        while in_flight and (block or in_flight[0][0].done()):
+            future, events = in_flight.popleft()
+            response = future.result()
+            if response is None:
+                progress["failed"] += len(events)
+                continue
+            for event, record in zip(events, loads(response.content)['records']):
+                calendar.patch_event(event['id'], record['id'], start=parse_event_time(event['start']['dateTime']),
+                                     duration=record['fields'].get("duration") or 1)
+            progress["done"] += len(events)
+
+    started = time.monotonic()
+    count = 0
+    events = (event for event in calendar.list_events(time_min, time_max)
+              if event['id'] not in linked_event_ids and not record_id_of(event)
+              and get_in(event, ['start', 'dateTime']))
+    for checkpoint_events in chunks(BACKFILL_CHECKPOINT, events):
+        for request_events in chunks(MAX_AIRTABLE_PATCH, checkpoint_events):
+            payload = {"records": [{"fields": event_record_fields(event, today)} for event in request_events],
+                       "typecast": True}
+            in_flight.append((table.writer.submit('post', payload), request_events))
+            tag_events(block=False)
+        tag_events(block=True)
+        calendar.flush()
+        table.writer.wait()
+        count += len(checkpoint_events)
+        checkpoint(state_store, key, progress)
+        report_progress(f'Import into {table_key(table)}', progress, count, started)
+
+    metrics.count('backfill.events_imported', count)
+    checkpoint(state_store, key, None)
+    return progress
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--import', dest='import_events', action='store_true',
+                        help='import the calendar events into Airtable instead')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='only import events from this date')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='only import events before this date')
+    args = parser.parse_args()
+
+    for pair in load_sync_config():
+        pair_table = get_table(pair["base"], pair["table"])
+        pair_calendar = Calendar(pair["calendar_id"], batch=True, snapshot_cache=get_snapshot_cache())
+        if args.import_events:
+            import_events(pair_calendar, pair_table, get_state_store(), args.since, args.until)
+        else:
+            backfill(pair_calendar, pair_table, get_state_store(), get_journal())
@@ -2,57 +2,375 @@
 
 This module creates a class for simplified interfacing with the Google Calendar API.
 """
-from typing import Dict
-from datetime import datetime, timedelta
+import base64
+import inspect
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+from datetime import datetime, timedelta, timezone
 
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from funcy import get_in, memoize, partial
+from googleapiclient.errors import HttpError
+
+from http_client import CONNECTION_ERRORS, MAX_RETRIES, CircuitOpenError, ResilientHttp, Retrier, backoff, is_transient
+from metrics import metrics
+from snapshot_cache import SnapshotCache
+from state_store import StateStore
 
 
 SCOPES = ['https://www.googleapis.com/auth/calendar']
-SERVICE_ACCOUNT_FILE = './service-account-credentials.json'
+SERVICE_ACCOUNT_FILE = os.getenv('SERVICE_ACCOUNT_FILE', './service-account-credentials.json')
 
 TIMEZONE = 'UTC'
+_local = threading.local()
+MAX_BATCH_SIZE = 50  # Google API batch requests accept at most 50 calls
+MAX_LIST_RESULTS = 2500  # largest page events().list returns
+USER_AGENT = 'airtable-gcal-sync (gzip)'  # Google only gzips responses for user agents containing "gzip"
+BASE32HEX = bytes.maketrans(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567', b'0123456789ABCDEFGHIJKLMNOPQRSTUV')
+RECORD_PROPERTY = 'airtableRecordId'  # private extended property tagging events with their record id
+RECORD_TAG = ' s3'  # suffix of the `"<recordId> s3"` description of the events created by the sync
+
+# partial responses: only the parts of the event resources the sync reads are returned
+EVENT_FIELDS = 'id,etag,status,start/dateTime,end/dateTime'
+WRITE_FIELDS = 'id,etag'  # inserts and patches only read back the event id
+MERGE_FIELDS = 'id,etag,status,summary,description,extendedProperties/private,colorId,start/dateTime,end/dateTime'
+MAX_CONFLICT_RETRIES = 3
+CHANGES_FIELDS = ('nextPageToken,nextSyncToken,items(id,etag,status,description,extendedProperties/private,'
+                  'start/dateTime)')
+LIST_FIELDS = ('nextPageToken,items(id,etag,status,summary,description,extendedProperties/private,colorId,'
+               'start/dateTime,end/dateTime)')
+
+@memoize
+def get_credentials(service_account_file: str = SERVICE_ACCOUNT_FILE):
+    """ Loads the service account credentials, once per process (i.e. per warm Lambda container)
+
+    Args:
+        service_account_file (str): (optional) Path to the service account credentials JSON
+
+    Returns:
+        The Google service account Credentials
+    """
+    # imported lazily, google.oauth2 is slow to import and only needed once per container
+    from google.oauth2 import service_account
+
+    return service_account.Credentials.from_service_account_file(service_account_file, scopes=SCOPES)
+
+
+def parse_event_time(value: Optional[str]) -> Optional[datetime]:
+    """ Parses a Gcal dateTime into a naive UTC datetime, comparable with the record deadlines """
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def is_applied(event: Dict, key: str, value) -> bool:
+    """ Whether a field of a patch body already has its value in an event """
+    if isinstance(value, dict) and 'dateTime' in value:
+        return parse_event_time(get_in(event, [key, 'dateTime'])) == parse_event_time(value['dateTime'])
+    return event.get(key) == value
+
+
+def record_tag(airtable_record_id: str) -> Dict:
+    """ `extendedProperties` of an event body tagging the event with its record id """
+    return {'private': {RECORD_PROPERTY: airtable_record_id}}
+
+
+def record_id_of(event: Dict) -> Optional[str]:
+    """ Returns the Airtable record id an event was created for, or None for untagged events
+
+    Events are tagged through a private extended property (see :func:`record_tag`); the events
+    created before that are tagged through their `"<recordId> s3"` description.
+    """
+    record_id = get_in(event, ['extendedProperties', 'private', RECORD_PROPERTY])
+    if record_id:
+        return record_id
+    description = event.get('description') or ''
+    return description[:-len(RECORD_TAG)] if description.endswith(RECORD_TAG) else None
+
+
+def event_id_for(airtable_record_id: str) -> str:
+    """ Deterministic Gcal event id of a record's event
+
+    Gcal accepts client-supplied ids made of base32hex characters (a-v and 0-9), so the record id
+    is base32hex-encoded. Inserting the event of a record twice then fails with a 409 instead of
+    creating a duplicate.
+
+    Args:
+        airtable_record_id (str): Id of the Airtable record
+
+    Returns:
+        The event id
+    """
+    # base64.b32hexencode only exists from Python 3.10
+    return base64.b32encode(airtable_record_id.encode()).translate(BASE32HEX).decode().rstrip('=').lower()
+
+
+def get_transport(http):
+    """ Makes an httplib2 client resilient, and sets the gzip user agent on every request, including batch requests
+
+    Transient failures are retried with backoff behind the host's circuit breaker (see
+    :obj:`http_client.ResilientHttp`). httplib2 already keeps connections alive and sends
+    `Accept-Encoding: gzip`, but Google only compresses responses when the user agent contains
+    "gzip" too.
+
+    Args:
+        http: The httplib2 (or authorized) client to wrap
+
+    Returns:
+        The wrapped client
+    """
+    from googleapiclient.http import set_user_agent
+
+    return set_user_agent(ResilientHttp(http, Retrier('calendar')), USER_AGENT)
+
+
+def build_service(http):
+    """ Builds a Google Calendar v3 service sending its requests through `http`
+
+    With google-api-python-client 2.x, the discovery document bundled with the client is used
+    (`static_discovery`), so building the service does not fetch it over the network. Older
+    clients, which have no bundled documents, fetch it.
+
+    Args:
+        http: The httplib2 (or authorized) client of the service, e.g. from :func:`get_transport`
+
+    Returns:
+        Instantiated Google Calendar v3 service
+    """
+    from googleapiclient.discovery import build
+
+    if 'static_discovery' in inspect.signature(build).parameters:
+        return build('calendar', 'v3', http=http, static_discovery=True, cache_discovery=False)
+    return build('calendar', 'v3', http=http, cache_discovery=False)
+
+
+def get_service(service_account_file: str = SERVICE_ACCOUNT_FILE):
+    """ Builds the Google Calendar v3 service, once per thread (i.e. per warm Lambda container)
+
+    Services are cached per thread because their keep-alive httplib2 connections must not be
+    shared between threads.
+
+    Args:
+        service_account_file (str): (optional) Path to the service account credentials JSON
+
+    Returns:
+        Instantiated Google Calendar v3 service
+    """
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.http import build_http
+
+    services = _local.__dict__.setdefault('services', dict())
+    if service_account_file not in services:
+        http = get_transport(AuthorizedHttp(get_credentials(service_account_file), http=build_http()))
+        services[service_account_file] = build_service(http)
+    return services[service_account_file]
+
 
 class Calendar:
     """ This class contains the necessary information to interact with the Google Calendar API
     for a specific calendar.
 
     It proves methods to GET, PATCH, and POST events.
+
+    In batched mode, inserts and patches are queued instead of executed, and are sent as
+    Google API batch requests of up to MAX_BATCH_SIZE calls. The queue is flushed
+    automatically once full, and must be flushed with :meth:`flush` at the end of a run.
+
+    Requests are retried by the transport (see :func:`get_transport`), and the calls of a batch
+    that fail transiently are retried in another batch. A write that fails for good is recorded
+    in `failed` under its Airtable record id, rather than aborting the run.
+
+    Patches can also be staged with :meth:`stage_patch`, which merges every change made to the
+    same event into a single patch body that is sent by :meth:`commit_patches`. With a
+    :obj:`snapshot_cache.SnapshotCache`, staged patches that would not change the event's last
+    synced state are skipped.
+
+    Writes are conditional: the last known `etag` of each event (from listings, writes, or the
+    snapshot cache) is sent as `If-Match`, so an event modified in Gcal since it was last seen is
+    not blindly overwritten. Such conflicts (412) are resolved by :meth:`_merge_patch`. Reads send
+    `If-None-Match`, and an unchanged event comes back as a 304 answered from memory.
     
     Attributes:
         calendar_id: String containing the Google Calendar UUID 
         credentials: Google Credentials stored in the service-account-credential.json
         service: Instantitated Google Calendar v3 service
+        batch: Whether writes are queued into batch requests
+        patches_staged: Number of patch intents staged with :meth:`stage_patch`
+        patches_sent: Number of merged patches sent by :meth:`commit_patches`
+        patches_skipped: Number of merged patches skipped because the event was already up to date
+        snapshot_cache: Optional cache of the last synced state of each event
+        etags: Dict mapping event ids to their last known `etag`
+        failed: Dict mapping the Airtable record ids whose event write failed to the error
     """
-    def __init__(self, calendar_id: str):
+    def __init__(self, calendar_id: str, batch: bool = False, snapshot_cache: Optional[SnapshotCache] = None,
+                 service=None):
         """ Creates a :obj:`Calendar` object 
         
         Args:
             calendar_id (str): The string containing the Gcal UUID for which we want to instantiate a :obj:`calendar`
+            batch (bool): (optional) If True, queue writes and send them as batch requests
+            snapshot_cache (SnapshotCache): (optional) Cache used to skip no-op patches
+            service: (optional) Prebuilt Google Calendar v3 service, instead of the service account's
         """
         self.calendar_id = calendar_id
-        self.credentials = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+        self.credentials = get_credentials() if service is None else None
+        self.service = service or get_service()
+        self.batch = batch
+        self._queue = []  # (request, callback, on_conflict, record id) of the queued writes
+        self._staged_patches = dict()
+        self.patches_staged = 0
+        self.patches_sent = 0
+        self.patches_skipped = 0
+        self.snapshot_cache = snapshot_cache
+        self.next_sync_token = None
+        self.etags = dict()
+        self._read_cache = dict()
+        self._events = (None, None)
+        self.failed = dict()
+
+    def events(self):
+        """ The service's events collection, kept as googleapiclient rebuilds all of its methods on every call """
+        service, events = self._events
+        if service is not self.service:
+            events = self.service.events()
+            self._events = (self.service, events)
+        return events
+
+    @property
+    def pending(self) -> int:
+        """ Number of queued writes that have not been sent yet """
+        return len(self._queue)
+
+    def _execute(self, request, callback: Optional[Callable[[Dict], None]] = None,
+                 on_conflict: Optional[Callable[[], Optional[Dict]]] = None,
+                 record_id: Optional[str] = None) -> Optional[Dict]:
+        """ Executes a Gcal API request, or queues it when in batched mode
+
+        Args:
+            request: The unexecuted googleapiclient request
+            callback: (optional) Called with the API's response once the request succeeds
+            on_conflict: (optional) Called instead when the request fails with a conflict (409 or 412)
+            record_id: (optional) Id of the Airtable record the write is for. Its failure is then
+                recorded in `failed` instead of raised.
 
-        self.service = build('calendar', 'v3', credentials=self.credentials)
+        Returns:
+            Dict with the Gcal API's response, or None if the request was queued (or failed)
+        """
+        if self.batch:
+            self._queue.append((request, callback, on_conflict, record_id))
+            if len(self._queue) >= MAX_BATCH_SIZE:
+                self.flush()
+            return None
+
+        try:
+            with metrics.timer('calendar.' + request.methodId.split('.')[-1]):
+                response = request.execute()
+        except HttpError as error:
+            metrics.count('calendar.requests')
+            if error.resp.status in (409, 412) and on_conflict is not None:
+                return on_conflict()
+            if record_id is None:
+                raise
+            self._fail(record_id, error)
+            return None
+        except (CircuitOpenError, *CONNECTION_ERRORS) as error:
+            if record_id is None:
+                raise
+            self._fail(record_id, error)
+            return None
+        metrics.count('calendar.requests')
+        if callback:
+            callback(response)
+        return response
+
+    def _fail(self, record_id: Optional[str], error: Exception):
+        """ Records a write that failed for good """
+        print('Gcal write failed for record %s: %s' % (record_id, error))
+        metrics.count('calendar.writes_failed')
+        if record_id:
+            self.failed[record_id] = error
+
+    def flush(self) -> int:
+        """ Sends all queued writes as a single batch request
+
+        The calls that fail transiently (e.g. a 503 for one call of the batch) are sent again in
+        a new batch request after a backoff, up to MAX_RETRIES times.
 
-    def create_event(self, title, start, airtable_record_id, duration=1, timezone=TIMEZONE) -> Dict:
+        Returns:
+            The number of writes that were sent
+        """
+        sent = 0
+        attempt = 0
+        while self._queue:
+            queued, self._queue = self._queue, []
+            retry = []
+
+            def on_response(entry, request_id, response, exception):
+                request, callback, on_conflict, record_id = entry
+                if isinstance(exception, HttpError) and exception.resp.status in (409, 412) and on_conflict:
+                    try:
+                        on_conflict()
+                    except (HttpError, CircuitOpenError, *CONNECTION_ERRORS) as error:
+                        self._fail(record_id, error)
+                elif isinstance(exception, HttpError) and is_transient(exception.resp.status, exception.content) \
+                        and attempt < MAX_RETRIES:
+                    retry.append(entry)
+                elif exception is not None:
+                    self._fail(record_id, exception)
+                elif callback:
+                    callback(response)
+
+            batch_request = self.service.new_batch_http_request()
+            for entry in queued:
+                batch_request.add(entry[0], callback=partial(on_response, entry))
+            try:
+                with metrics.timer('calendar.batch'):
+                    batch_request.execute()
+            except (HttpError, CircuitOpenError, *CONNECTION_ERRORS) as error:
+                # the batch request itself failed, even after the transport's retries
+                for _, _, _, record_id in queued:
+                    self._fail(record_id, error)
+            metrics.count('calendar.requests')
+            metrics.count('calendar.batched_calls', len(queued))
+            sent += len(queued)
+
+            if retry:
+                metrics.count('calendar.retries', len(retry))
+                time.sleep(backoff(attempt))
+                self._queue = retry + self._queue
+                attempt += 1
+        return sent
+
+    def create_event(self, title, start, airtable_record_id, duration=1, timezone=TIMEZONE, callback=None,
+                     color_id=None) -> Dict:
         """ Create a Google Calendar event in the specified calendar object
 
+        The event gets the deterministic id of the record (see :func:`event_id_for`), so creating
+        it again, e.g. in a run resumed after a timeout, adopts the existing event (restoring it
+        if it was deleted) instead of duplicating it.
+
         Args:
             title (str): A string containing the event title/name 
             start (datetime): A datetime indicating the start time for the event
             airtable_record_id (str): Id corresponding to the airtable record representation for this event
             duration (float): The duration (in hours) that the event should last
             timezone (str): (optional) The timezone in which the event should be encoded
+            callback (callable): (optional) Called with the created event once the insert succeeds
+            color_id (str): (optional) string version of number (1-11) based off of Gcal event colors
 
         Returns:
-            Dict with the Gcal API's response to the insert request
+            Dict with the Gcal API's response to the insert request, or None if the request was queued
         """
+        event_id = event_id_for(airtable_record_id)
         event_body = {
+            'id': event_id,
             'summary': title,
-            'description': airtable_record_id + " s3",
+            'description': airtable_record_id + RECORD_TAG,
+            'extendedProperties': record_tag(airtable_record_id),
             'start': {
                 'dateTime': start.isoformat(),
                 'timeZone': timezone,
@@ -62,13 +380,26 @@ class Calendar:
                 'timeZone': timezone,
             }
         }
+        if color_id:
+            event_body.update({'colorId': color_id})
 
-        created_event = self.service.events().insert(calendarId=self.calendar_id, body=event_body).execute()
-        print('Event created: %s' % (created_event.get('htmlLink')))
+        def on_created(created_event):
+            print('Event created: %s' % (created_event.get('id')))
+            self.etags[created_event['id']] = created_event.get('etag')
+            if self.snapshot_cache:
+                self.snapshot_cache.update(airtable_record_id, created_event['id'],
+                                           {'title': title, 'start': start, 'duration': duration,
+                                            'color_id': color_id},
+                                           created_event.get('etag'))
+            if callback:
+                callback(created_event)
 
-        return created_event
+        request = self.events().insert(calendarId=self.calendar_id, body=event_body, fields=WRITE_FIELDS)
+        adopt = partial(self._merge_patch, event_id, dict(event_body, status='confirmed'), on_created)
+        return self._execute(request, on_created, adopt, airtable_record_id)
 
-    def patch_event(self, event_id, airtable_record_id, color_id=None, title=None, start=None, duration=1, timezone=TIMEZONE):
+    def patch_event(self, event_id, airtable_record_id, color_id=None, title=None, start=None, duration=1, timezone=TIMEZONE,
+                    callback=None, etag=None):
         """ Patch a Google Calendar event in the specified calendar object
 
         Args:
@@ -79,9 +410,11 @@ class Calendar:
             start (datetime): (optional) If present, the new start time for the event
             duration (float): (optional) If present, the new duration (in hours) for the event
             timezone (str): (optional) If present, the timezone in which the event should be encoded 
+            callback (callable): (optional) Called with the patched event once the patch succeeds
+            etag (str): (optional) `etag` the event must still have, defaulting to the last known one
         
         Returns:
-            Dict with the Gcal API's response to the patch request
+            Dict with the Gcal API's response to the patch request, or None if the request was queued
         """
         if not event_id:
             return None
@@ -99,22 +432,128 @@ class Calendar:
                     'dateTime': (start + timedelta(hours=duration)).isoformat(),
                     'timeZone': timezone,
                 },
-                'description': airtable_record_id + " s3",
+                # tagged without touching the description, which may be the user's (e.g. imported events)
+                'extendedProperties': record_tag(airtable_record_id),
             })
         if title:
             event_body.update({'summary': title,})
 
-        # TODO: Error Handling
-        patched_event = self.service.events().patch(calendarId=self.calendar_id, eventId=event_id, body=event_body).execute()
-        print('Event patched: %s' % (patched_event.get('htmlLink')))
+        def on_patched(patched_event):
+            print('Event patched: %s' % (patched_event.get('id')))
+            self.etags[event_id] = patched_event.get('etag')
+            if callback:
+                callback(patched_event)
 
-        return patched_event
+        request = self.events().patch(calendarId=self.calendar_id, eventId=event_id, body=event_body,
+                                      fields=WRITE_FIELDS)
+        etag = etag or self.etags.get(event_id)
+        if etag:
+            request.headers['If-Match'] = etag
+        return self._execute(request, on_patched, partial(self._merge_patch, event_id, event_body, on_patched),
+                             airtable_record_id)
+
+    def _merge_patch(self, event_id: str, event_body: Dict, callback: Callable[[Dict], None]) -> Optional[Dict]:
+        """ Resolves a conflicting write: the event was modified since its `etag` was seen (412), or
+        an event with the same id already exists (409)
+
+        The event is re-read, the parts of the write it already has are dropped (avoiding a
+        duplicate write), and the rest is sent again as a patch with the current `etag`. As in the
+        rest of the sync, Airtable wins when both sides changed the same field.
+
+        Args:
+            event_id (str): String containing the Id of the event
+            event_body (dict): Body of the conflicting write
+            callback (callable): Called with the event once the patch is applied
+
+        Returns:
+            Dict with the patched event, or None if it kept conflicting
+        """
+        metrics.count('calendar.conflicts')
+        for _ in range(MAX_CONFLICT_RETRIES):
+            current = self.get_event(event_id, fields=MERGE_FIELDS)
+            remaining = {key: value for key, value in event_body.items() if not is_applied(current, key, value)}
+            if not remaining:
+                callback(current)
+                return current
+
+            request = self.events().patch(calendarId=self.calendar_id, eventId=event_id, body=remaining,
+                                          fields=WRITE_FIELDS)
+            request.headers['If-Match'] = current['etag']
+            try:
+                with metrics.timer('calendar.patch'):
+                    patched_event = request.execute()
+            except HttpError as error:
+                if error.resp.status != 412:
+                    raise
+                continue
+            finally:
+                metrics.count('calendar.requests')
+            callback(patched_event)
+            return patched_event
+
+        print('Event %s kept changing, patch abandoned' % event_id)
+        return None
     
-    def get_event(self, event_id):
+    def stage_patch(self, event_id, airtable_record_id, **changes):
+        """ Stages a patch intent for an event, without sending it
+
+        Changes staged for the same event are merged, later values winning, so that
+        :meth:`commit_patches` sends one minimal patch per event.
+
+        Args:
+            event_id (str): String containing the Id for the existing Gcal event to be edited
+            airtable_record_id (str): Id corresponding to the airtable record representation for this event
+            **changes: Any of the optional keyword arguments of :meth:`patch_event` (color_id, title, start, duration)
+        """
+        if not event_id:
+            return
+
+        staged = self._staged_patches.setdefault(event_id, {'airtable_record_id': airtable_record_id})
+        staged.update({key: value for key, value in changes.items() if value is not None})
+        self.patches_staged += 1
+
+    def commit_patches(self) -> int:
+        """ Sends one merged patch for every event with staged changes
+
+        Returns:
+            The number of patches that were sent (or queued, in batched mode)
+        """
+        staged_patches, self._staged_patches = self._staged_patches, dict()
+        sent = 0
+        for event_id, changes in staged_patches.items():
+            record_id = changes['airtable_record_id']
+            if self.snapshot_cache:
+                changes = self.snapshot_cache.diff(record_id, event_id, changes)
+                if not changes:
+                    self.patches_skipped += 1
+                    continue
+
+            def remember(patched_event, record_id=record_id, event_id=event_id, changes=changes):
+                if self.snapshot_cache:
+                    self.snapshot_cache.update(record_id, event_id, changes, patched_event.get('etag'))
+
+            etag = self.etags.get(event_id)
+            if etag is None and self.snapshot_cache:
+                etag = self.snapshot_cache.etag(record_id, event_id)
+            self.patch_event(event_id, callback=remember, etag=etag, **changes)
+            sent += 1
+        self.patches_sent += sent
+        return sent
+
+    @property
+    def patches_saved(self) -> int:
+        """ Number of Gcal API calls avoided by merging staged patches and skipping no-op patches """
+        return self.patches_staged - self.patches_sent
+
+    def get_event(self, event_id, fields=EVENT_FIELDS):
         """ Get a Google Calendar event in the specified calendar object
 
+        Events read before are re-read conditionally (`If-None-Match`), and served from memory
+        when Gcal answers that they did not change (304).
+
         Args:
             event_id (str): String containing the Id for the existing Gcal event to retrieve 
+            fields (str): (optional) Partial response projection of the event
         
         Returns:
             Dict with the Gcal API's response to the get request
@@ -122,4 +561,173 @@ class Calendar:
         if not event_id:
             return None
 
-        return self.service.events().get(calendarId=self.calendar_id, eventId=event_id).execute()
+        cached = self._read_cache.get((event_id, fields))
+        request = self.events().get(calendarId=self.calendar_id, eventId=event_id, fields=fields)
+        if cached:
+            request.headers['If-None-Match'] = cached['etag']
+        try:
+            with metrics.timer('calendar.get'):
+                event = request.execute()
+        except HttpError as error:
+            if error.resp.status != 304 or not cached:
+                raise
+            metrics.count('calendar.not_modified')
+            event = cached
+        finally:
+            metrics.count('calendar.requests')
+
+        self._read_cache[(event_id, fields)] = event
+        self.etags[event_id] = event.get('etag')
+        return event
+
+    def list_events(self, time_min: Optional[datetime] = None, time_max: Optional[datetime] = None,
+                    fields: str = LIST_FIELDS) -> Iterator[Dict]:
+        """ Streams the calendar's events, a page of up to MAX_LIST_RESULTS events at a time
+
+        Only the `fields` needed to compare events with their records are requested, which keeps
+        the pages small enough to list a whole calendar in a handful of calls.
+
+        Args:
+            time_min (datetime): (optional) Only list events ending after this (UTC) time
+            time_max (datetime): (optional) Only list events starting before this (UTC) time
+            fields (str): (optional) Partial response projection of each page
+
+        Returns:
+            Iterator over the (non-deleted) events
+        """
+        params = {'calendarId': self.calendar_id, 'maxResults': MAX_LIST_RESULTS, 'fields': fields}
+        if time_min:
+            params['timeMin'] = time_min.strftime('%Y-%m-%dT%H:%M:%SZ')
+        if time_max:
+            params['timeMax'] = time_max.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        page_token = None
+        while True:
+            with metrics.timer('calendar.list'):
+                response = self.events().list(pageToken=page_token, **params).execute()
+            metrics.count('calendar.requests')
+            for event in response.get('items', []):
+                self._remember_etag(event)
+                yield event
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
+    def delete_event(self, event_id, callback=None) -> Optional[Dict]:
+        """ Delete a Google Calendar event in the specified calendar object
+
+        Args:
+            event_id (str): String containing the Id for the existing Gcal event to delete
+            callback (callable): (optional) Called once the delete succeeds
+
+        Returns:
+            Dict with the Gcal API's (empty) response, or None if the request was queued
+        """
+        if not event_id:
+            return None
+
+        request = self.events().delete(calendarId=self.calendar_id, eventId=event_id)
+        return self._execute(request, callback)
+
+    def list_changes(self, state_store: StateStore) -> List[Dict]:
+        """ Lists the events that changed since the last saved sync token
+
+        Uses the `syncToken` stored in `state_store` for incremental sync. Without a stored
+        token, or when Google expired it (410 Gone), every event is listed (full resync).
+        The new sync token is kept in `next_sync_token` until :meth:`save_sync_token` is
+        called, so changes are only marked as seen once the caller has processed them.
+
+        The snapshots of the events changed by someone else than the sync are dropped (see
+        :meth:`snapshot_cache.SnapshotCache.invalidate`), so the next patches to them are sent.
+
+        Args:
+            state_store (StateStore): Store holding the sync token between runs
+
+        Returns:
+            List of changed events, including deleted events (with `status` "cancelled")
+        """
+        sync_token = state_store.get(self.sync_token_key)
+        events = []
+        page_token = None
+
+        while True:
+            params = {'calendarId': self.calendar_id, 'showDeleted': True, 'pageToken': page_token,
+                      'maxResults': MAX_LIST_RESULTS, 'fields': CHANGES_FIELDS}
+            if sync_token:
+                params['syncToken'] = sync_token
+            try:
+                with metrics.timer('calendar.list'):
+                    response = self.events().list(**params).execute()
+                metrics.count('calendar.requests')
+            except HttpError as error:
+                if error.resp.status != 410 or not sync_token:
+                    raise
+                print('Sync token expired, doing a full resync')
+                sync_token, page_token, events = None, None, []
+                continue
+
+            for event in response.get('items', []):
+                self._remember_etag(event)
+                if self.snapshot_cache:
+                    self.snapshot_cache.invalidate(event['id'], event.get('etag'))
+                events.append(event)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+
+        self.next_sync_token = response.get('nextSyncToken')
+        return events
+
+    def _remember_etag(self, event: Dict):
+        """ Keeps the `etag` of a listed event for the conditional writes that follow """
+        if event.get('status') == 'cancelled':
+            self.etags.pop(event['id'], None)
+        elif event.get('etag'):
+            self.etags[event['id']] = event['etag']
+
+    def save_sync_token(self, state_store: StateStore):
+        """ Persists the sync token returned by the last :meth:`list_changes` call
+
+        Args:
+            state_store (StateStore): Store holding the sync token between runs
+        """
+        if self.next_sync_token:
+            state_store.set(self.sync_token_key, self.next_sync_token)
+
+    @property
+    def sync_token_key(self) -> str:
+        """ Key under which this calendar's sync token is stored """
+        return 'syncToken:' + self.calendar_id
+
+    def watch(self, channel_id: str, address: str, token: Optional[str] = None, ttl: Optional[int] = None) -> Dict:
+        """ Opens a push notification channel for changes to the calendar's events
+
+        Args:
+            channel_id (str): Unique id of the new channel (e.g. a UUID)
+            address (str): HTTPS url receiving the notifications
+            token (str): (optional) Secret sent back in the `X-Goog-Channel-Token` header of each notification
+            ttl (int): (optional) Requested lifetime of the channel, in seconds
+
+        Returns:
+            Dict with the Gcal API's channel resource, including its `resourceId` and `expiration` (ms)
+        """
+        body = {'id': channel_id, 'type': 'web_hook', 'address': address}
+        if token:
+            body['token'] = token
+        if ttl:
+            body['params'] = {'ttl': str(ttl)}
+
+        with metrics.timer('calendar.watch'):
+            channel = self.events().watch(calendarId=self.calendar_id, body=body).execute()
+        metrics.count('calendar.requests')
+        return channel
+
+    def stop_channel(self, channel: Dict):
+        """ Stops a push notification channel opened with :meth:`watch`
+
+        Args:
+            channel (dict): The channel resource returned by :meth:`watch`
+        """
+        with metrics.timer('calendar.stop_channel'):
+            self.service.channels().stop(body={'id': channel['id'], 'resourceId': channel['resourceId']}).execute()
+        metrics.count('calendar.requests')
@@ -0,0 +1,184 @@
+""" daemon.py
+
+This module provides a long-running alternative to the periodic Lambda: it keeps Gcal push
+notification channels open for every configured calendar, receives the notifications on a small
+asyncio HTTP server, and runs a targeted :func:`sync_script.sync_calendar_changes` for the
+affected pair a few seconds after each burst of notifications. A full :func:`sync_script.sync_all`
+still runs every `POLL_INTERVAL_SECONDS` for the Airtable-side changes, which are not pushed.
+
+Configuration (env):
+    WEBHOOK_ADDRESS: Public HTTPS url forwarding to this daemon (required)
+    WEBHOOK_TOKEN: (optional) Secret checked against the X-Goog-Channel-Token header
+    DAEMON_HOST / DAEMON_PORT: Address to listen on (default 0.0.0.0:8080)
+    DEBOUNCE_SECONDS: Quiet time after a notification before syncing (default 2)
+    POLL_INTERVAL_SECONDS: Interval of the full sync (default 900)
+
+Usage:
+    python daemon.py
+"""
+import asyncio
+import os
+import time
+import uuid
+from functools import partial
+from typing import Dict, List, Optional
+
+from airtable_request import get_table
+from calendar_request import Calendar
+from state_store import FileStateStore, get_state_store
+from journal import get_journal
+from snapshot_cache import get_snapshot_cache
+from sync_script import load_sync_config, sync_all, sync_calendar_changes
+
+WEBHOOK_ADDRESS = os.getenv('WEBHOOK_ADDRESS')
+WEBHOOK_TOKEN = os.getenv('WEBHOOK_TOKEN')
+DAEMON_HOST = os.getenv('DAEMON_HOST', '0.0.0.0')
+DAEMON_PORT = int(os.getenv('DAEMON_PORT', 8080))
+DEBOUNCE_SECONDS = float(os.getenv('DEBOUNCE_SECONDS', 2))
+POLL_INTERVAL_SECONDS = float(os.getenv('POLL_INTERVAL_SECONDS', 900))
+CHANNEL_TTL = 7 * 24 * 3600  # the maximum lifetime Gcal grants to events channels
+CHANNEL_RENEWAL_MARGIN = 3600  # renew channels this many seconds before they expire
+MAX_HEADER_BYTES = 16 * 1024
+
+
+class Daemon:
+    """ Keeps the configured pairs in sync from Gcal push notifications
+
+    Attributes:
+        pairs: Dicts with the "base", "table" and "calendar_id" of each pair
+        address: Public url Gcal sends the notifications to
+        token: Secret expected in the `X-Goog-Channel-Token` header
+        state_store: The :obj:`state_store.StateStore` holding sync tokens and watermarks
+        channels: Dict mapping open channel ids to (pair index, channel resource)
+    """
+    def __init__(self, pairs: List[Dict], address: str, token: Optional[str] = WEBHOOK_TOKEN,
+                 debounce: float = DEBOUNCE_SECONDS, poll_interval: float = POLL_INTERVAL_SECONDS):
+        self.pairs = pairs
+        self.address = address
+        self.token = token
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.state_store = get_state_store() or FileStateStore('sync-state.json')
+        self.snapshot_cache = get_snapshot_cache()
+        self.journal = get_journal()
+        self.channels = dict()
+        self._pending = dict()
+        self._locks = []
+
+    async def run(self):
+        """ Opens the channels, then serves notifications until cancelled """
+        # created on the running loop: before Python 3.10, a lock binds to the loop current at its creation
+        self._locks = [asyncio.Lock() for _ in self.pairs]
+        server = await asyncio.start_server(self.handle_connection, DAEMON_HOST, DAEMON_PORT)
+        print(f'Listening for Gcal notifications on {DAEMON_HOST}:{DAEMON_PORT}')
+        tasks = [asyncio.create_task(self.keep_channel_open(index)) for index in range(len(self.pairs))]
+        tasks.append(asyncio.create_task(self.poll()))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def in_thread(self, function, *args):
+        """ Runs blocking sync code on the event loop's default thread pool """
+        return await asyncio.get_running_loop().run_in_executor(None, partial(function, *args))
+
+    async def keep_channel_open(self, index: int):
+        """ Opens a channel for a pair's calendar, and replaces it shortly before it expires """
+        calendar_id = self.pairs[index]["calendar_id"]
+        calendar = None
+        channel = None
+        while True:
+            try:
+                if calendar is None:
+                    # building the client reads credentials and discovery documents, so not on the event loop
+                    calendar = await self.in_thread(Calendar, calendar_id)
+                new_channel = await self.in_thread(
+                    calendar.watch, str(uuid.uuid4()), self.address, self.token, CHANNEL_TTL)
+            except Exception as error:
+                print(f'Opening a channel failed for {calendar_id}: {error!r}')
+                await asyncio.sleep(60)
+                continue
+
+            self.channels[new_channel['id']] = (index, new_channel)
+            if channel is not None:
+                # the new channel is open, so no notification is lost while closing the old one
+                self.channels.pop(channel['id'], None)
+                try:
+                    await self.in_thread(calendar.stop_channel, channel)
+                except Exception as error:
+                    print(f'Stopping channel {channel["id"]} failed: {error!r}')
+            channel = new_channel
+
+            expires_in = int(channel['expiration']) / 1000 - time.time()
+            await asyncio.sleep(max(60, expires_in - CHANNEL_RENEWAL_MARGIN))
+
+    async def poll(self):
+        """ Runs a full sync of every pair on a fixed interval, for Airtable-side changes """
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            for lock in self._locks:
+                await lock.acquire()
+            try:
+                await self.in_thread(partial(sync_all, self.pairs, state_store=self.state_store,
+                                             snapshot_cache=self.snapshot_cache, journal=self.journal))
+            finally:
+                for lock in self._locks:
+                    lock.release()
+
+    def notify(self, channel_id: str):
+        """ Debounces a notification: the pair syncs once no notification arrived for `debounce` seconds """
+        if channel_id not in self.channels:
+            return
+        index = self.channels[channel_id][0]
+        if index in self._pending:
+            self._pending[index].cancel()
+        self._pending[index] = asyncio.get_running_loop().call_later(
+            self.debounce, lambda: asyncio.create_task(self.sync_pair(index)))
+
+    async def sync_pair(self, index: int):
+        """ Runs a targeted sync of the changed events of a pair """
+        self._pending.pop(index, None)
+        pair = self.pairs[index]
+        async with self._locks[index]:
+            try:
+                await self.in_thread(sync_calendar_changes, pair["calendar_id"], get_table(pair["base"], pair["table"]),
+                                     self.state_store, self.snapshot_cache, self.journal)
+            except Exception as error:
+                print(f'Sync failed for {pair["base"]}/{pair["table"]}: {error!r}')
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """ Minimal HTTP/1.1 handler for Gcal notification POSTs """
+        try:
+            head = await reader.readuntil(b'\r\n\r\n')
+            if len(head) > MAX_HEADER_BYTES:
+                raise ValueError('headers too large')
+            request_line, *header_lines = head.decode('latin-1').split('\r\n')
+            headers = {name.strip().lower(): value.strip() for name, _, value in
+                       (line.partition(':') for line in header_lines if line)}
+            await reader.readexactly(int(headers.get('content-length', 0)))
+
+            status = '200 OK'
+            if self.token and headers.get('x-goog-channel-token') != self.token:
+                status = '403 Forbidden'
+            elif headers.get('x-goog-resource-state') not in (None, 'sync'):
+                self.notify(headers.get('x-goog-channel-id'))
+
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.encode())
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def main():
+    if not WEBHOOK_ADDRESS:
+        raise SystemExit('WEBHOOK_ADDRESS must be set to the public url of this daemon')
+    asyncio.run(Daemon(load_sync_config(), WEBHOOK_ADDRESS).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+""" http_client.py
+
+This module provides the resilient HTTP layer shared by the Airtable and Google Calendar clients:
+transient failures (connection errors, 429s, 5xx and Gcal's rate limit 403s) are retried with
+jittered exponential backoff, honoring `Retry-After`, and every host sits behind a
+:obj:`CircuitBreaker` that fails requests fast while the host keeps failing.
+
+Requests that are not idempotent (Airtable POSTs, which create records) are only retried when
+they cannot have reached the server: after a failure to connect, or a 429.
+
+Airtable requests go through a :obj:`ResilientSession` (a pooled `requests` session), Gcal
+requests through a :obj:`ResilientHttp` wrapping the httplib2 client of the Google API service
+(see :func:`calendar_request.get_transport`).
+"""
+import http.client
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from funcy import memoize
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from metrics import metrics
+
+MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 5))
+BACKOFF_BASE = 1.0  # seconds, doubled on every retry
+MAX_BACKOFF = 32.0
+BREAKER_THRESHOLD = int(os.getenv('CIRCUIT_BREAKER_THRESHOLD', 10))  # consecutive failures opening a circuit
+BREAKER_COOLDOWN = float(os.getenv('CIRCUIT_BREAKER_COOLDOWN_SECONDS', 30))
+POOL_SIZE = 10  # keep-alive connections per host
+TIMEOUT = (float(os.getenv('HTTP_CONNECT_TIMEOUT_SECONDS', 5)),
+           float(os.getenv('HTTP_READ_TIMEOUT_SECONDS', 60)))  # (connect, read) seconds of the sessions' requests
+
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+CONNECTION_ERRORS = (OSError, http.client.HTTPException)  # includes requests' ConnectionError and Timeout
+
+
+class CircuitOpenError(Exception):
+    """ Raised instead of sending a request to a host whose circuit is open """
+
+
+def is_transient(status: int, content: bytes = b'') -> bool:
+    """ Whether a response status is worth retrying, including Gcal's "rateLimitExceeded" 403s """
+    if status == 403:
+        return b'ateLimitExceeded' in (content or b'')
+    return status in RETRYABLE_STATUSES
+
+
+def is_connect_error(error: Exception) -> bool:
+    """ Whether a `requests` connection error happened before the request was sent (refused, DNS, connect timeout) """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """ Parses a `Retry-After` header (delay in seconds, or HTTP date) into seconds """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt: int) -> float:
+    """ Jittered ("full jitter") exponential backoff before retry number `attempt` (from 0) """
+    return random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """ Thread-safe circuit breaker of a host
+
+    After `threshold` consecutive failures the circuit opens, and requests to the host fail
+    fast with :obj:`CircuitOpenError`. Once `cooldown` seconds have passed, a single request
+    is let through to probe the host (half-open): its success closes the circuit, its failure
+    opens it again.
+
+    Attributes:
+        host: Host name (and port) of the circuit
+        threshold: Number of consecutive failures opening the circuit
+        cooldown: Seconds the circuit stays open before a probe
+        failures: Current number of consecutive failures
+        opened_at: `time.monotonic()` time the circuit opened, None while closed
+    """
+    def __init__(self, host: str, threshold: int = BREAKER_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Raises :obj:`CircuitOpenError` unless a request may be sent to the host """
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if not self._probing and time.monotonic() - self.opened_at >= self.cooldown:
+                self._probing = True
+                return
+        metrics.count('http.circuit_rejected')
+        raise CircuitOpenError(f'{self.host} keeps failing, requests suspended for {self.cooldown:.0f}s')
+
+    def record(self, success: bool):
+        """ Records the outcome of a request to the host """
+        with self._lock:
+            self._probing = False
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is None and self.failures < self.threshold:
+                return
+            if self.opened_at is None:
+                print(f'Circuit opened for {self.host} after {self.failures} consecutive failures')
+                metrics.count('http.circuit_opened')
+            self.opened_at = time.monotonic()
+
+
+@memoize
+def get_breaker(host: str) -> CircuitBreaker:
+    """ Returns the :obj:`CircuitBreaker` of a host, shared by every client of the process """
+    return CircuitBreaker(host)
+
+
+class Retrier:
+    """ Sends requests through the circuit breaker of their host, retrying transient failures
+
+    Attributes:
+        name: Prefix of the metrics counters ("airtable", "calendar")
+        max_retries: Number of times a failing request is retried
+        rate_limit_penalty: (optional) Seconds to wait after a 429 without `Retry-After`,
+            instead of the exponential backoff
+        throttle: (optional) Called before every attempt, e.g. to wait for a rate limiter token
+    """
+    def __init__(self, name: str, max_retries: int = MAX_RETRIES, rate_limit_penalty: Optional[float] = None,
+                 throttle: Optional[Callable[[], None]] = None):
+        self.name = name
+        self.max_retries = max_retries
+        self.rate_limit_penalty = rate_limit_penalty
+        self.throttle = throttle
+
+    def delay(self, attempt: int, status: Optional[int], retry_after: Optional[str]) -> float:
+        """ Seconds to wait before retrying a request that failed with `status` (None for connection errors) """
+        seconds = parse_retry_after(retry_after)
+        if seconds is not None:
+            return seconds
+        if status == 429 and self.rate_limit_penalty is not None:
+            return self.rate_limit_penalty
+        return backoff(attempt)
+
+    def send(self, host: str, send: Callable, inspect: Callable[..., Tuple[int, Optional[str], bytes]],
+             idempotent: bool = True):
+        """ Sends a request, retrying it while it fails transiently
+
+        A request that is not idempotent may have been applied when its connection broke or the
+        server answered 5xx, so it is only retried after a connect-phase failure (see
+        :func:`is_connect_error`) or a 429.
+
+        Args:
+            host: Host the request is sent to, which selects its circuit breaker
+            send: Sends the request once and returns the response
+            inspect: Returns the (status, `Retry-After` header, body) of a response
+            idempotent: (optional) False if sending the request twice may apply it twice
+
+        Returns:
+            The first non-transient response, or the last response once the retries are exhausted
+
+        Raises:
+            CircuitOpenError: if the host's circuit is open
+            OSError, http.client.HTTPException: if the last attempt failed to connect
+        """
+        breaker = get_breaker(host)
+        for attempt in range(self.max_retries + 1):
+            breaker.allow()
+            if self.throttle:
+                with metrics.timer(self.name + '.rate_limit_wait'):
+                    self.throttle()
+            try:
+                response = send()
+            except CONNECTION_ERRORS as error:
+                breaker.record(False)
+                if attempt == self.max_retries or not (idempotent or is_connect_error(error)):
+                    raise
+                print(f'{self.name} request failed ({error!r}), retrying')
+                status, retry_after = None, None
+            else:
+                status, retry_after, content = inspect(response)
+                transient = is_transient(status, content)
+                # a host that rate limits, or answers 4xx, is up: only errors and timeouts count against it
+                breaker.record(not transient or status in (403, 429))
+                if not transient or attempt == self.max_retries or not (idempotent or status == 429):
+                    return response
+            metrics.count(self.name + '.retries')
+            time.sleep(self.delay(attempt, status, retry_after))
+
+
+class ResilientSession(requests.Session):
+    """ Pooled `requests` session whose requests are sent by a :obj:`Retrier`
+
+    POST requests are sent as not idempotent (see :meth:`Retrier.send`).
+
+    Attributes:
+        retrier: The :obj:`Retrier` sending every request of the session
+        timeout: (connect, read) timeout in seconds of the requests that do not set their own
+    """
+    def __init__(self, retrier: Retrier, pool_size: int = POOL_SIZE, timeout: Tuple[float, float] = TIMEOUT):
+        super().__init__()
+        self.retrier = retrier
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, *args, **kwargs) -> requests.Response:
+        send = super().request
+        kwargs.setdefault('timeout', self.timeout)
+        return self.retrier.send(
+            urlparse(url).netloc, lambda: send(method, url, *args, **kwargs),
+            lambda response: (response.status_code, response.headers.get('Retry-After'), response.content),
+            idempotent=method.upper() != 'POST')
+
+
+class ResilientHttp:
+    """ Wraps an httplib2 client (as used by googleapiclient) so that its requests are sent by a :obj:`Retrier`
+
+    Every other attribute is the wrapped client's, so credentials refresh and batch requests
+    keep working.
+
+    Gcal POSTs are retried like any other request: the events are inserted with deterministic
+    ids (see :func:`calendar_request.event_id_for`), so an insert applied twice conflicts and
+    is adopted rather than duplicated.
+
+    Attributes:
+        http: The wrapped httplib2 (or authorized) client
+        retrier: The :obj:`Retrier` sending every request
+    """
+    def __init__(self, http, retrier: Retrier):
+        self.http = http
+        self.retrier = retrier
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        return self.retrier.send(
+            urlparse(uri).netloc, lambda: self.http.request(uri, method, body, headers, *args, **kwargs),
+            lambda response: (response[0].status, response[0].get('retry-after'), response[1]))
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
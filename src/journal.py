@@ -0,0 +1,90 @@
+""" journal.py
+
+This module provides a local SQLite write-ahead journal of the Airtable updates of a sync run,
+so that a run interrupted after its Gcal writes (e.g. by a Lambda timeout) can be resumed.
+
+Each record's update is journaled as soon as its Gcal writes have completed, and cleared once
+Airtable has stored it. The next run replays whatever is left before anything else (see
+:func:`sync_script.update_records`), so records come back with their `calendarEventId`,
+`lastDeadline`, etc. already set and the rules have nothing left to redo.
+"""
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, Optional
+
+
+class Journal:
+    """ Persistent journal of the pending Airtable updates of each table
+
+    The journal is safe to share between threads. Every write is committed right away, in WAL
+    mode so that commits stay cheap.
+
+    Attributes:
+        path: Path to the SQLite database
+        connection: Open SQLite connection
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS pending_updates (
+                table_key TEXT NOT NULL,
+                record_id TEXT NOT NULL,
+                fields TEXT NOT NULL,
+                PRIMARY KEY (table_key, record_id)
+            )""")
+
+    def record(self, table_key: str, updates: Iterable[Dict]):
+        """ Journals record updates whose Gcal writes have completed, merging them with pending ones
+
+        Args:
+            table_key: Name ("base/table") of the table the records belong to
+            updates: Records ({"id", "fields"}) about to be sent to Airtable
+        """
+        with self._lock:
+            for update in updates:
+                row = self.connection.execute(
+                    "SELECT fields FROM pending_updates WHERE table_key = ? AND record_id = ?",
+                    (table_key, update['id'])).fetchone()
+                fields = dict(json.loads(row[0]) if row else {}, **update['fields'])
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO pending_updates (table_key, record_id, fields) VALUES (?, ?, ?)",
+                    (table_key, update['id'], json.dumps(fields)))
+            self.connection.commit()
+
+    def pending(self, table_key: str) -> Dict[str, Dict]:
+        """ Returns the journaled updates not yet acknowledged by Airtable, by record id """
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT record_id, fields FROM pending_updates WHERE table_key = ?", (table_key,)).fetchall()
+        return {record_id: json.loads(fields) for record_id, fields in rows}
+
+    def clear(self, table_key: str, keep: Iterable[str] = ()):
+        """ Clears the pending updates of a table once Airtable has stored them
+
+        Args:
+            table_key: Name ("base/table") of the table
+            keep: (optional) Ids of the records whose update failed, which stay pending
+        """
+        keep = set(keep)
+        with self._lock:
+            record_ids = [record_id for record_id in self.pending(table_key) if record_id not in keep]
+            self.connection.executemany("DELETE FROM pending_updates WHERE table_key = ? AND record_id = ?",
+                                        [(table_key, record_id) for record_id in record_ids])
+            self.connection.commit()
+
+
+def get_journal() -> Optional[Journal]:
+    """ Opens the journal configured with `JOURNAL_PATH`
+
+    Returns:
+        The :obj:`Journal`, or None if no journal is configured
+    """
+    if os.getenv('JOURNAL_PATH'):
+        return Journal(os.getenv('JOURNAL_PATH'))
+    return None
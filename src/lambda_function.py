@@ -1,5 +1,12 @@
-from sync_script import sync
+import time
+
+from sync_script import SyncFailedError, sync_all
 
 def lambda_handler(event, context):
-    sync()
-    return
\ No newline at end of file
+    # stop scheduling work in time to flush it before Lambda kills the invocation
+    deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 if context else None
+    errors = sync_all(deadline=deadline)
+    if errors:
+        # fail the invocation, so that Lambda reports (and retries) it
+        raise SyncFailedError(errors)
+    return
@@ -0,0 +1,165 @@
+""" metrics.py
+
+This module records per-phase timings and counters of sync runs, and exports them as CloudWatch
+Embedded Metric Format (EMF) JSON lines or as a Prometheus text file.
+
+Export is configured with `METRICS_FORMAT` ("emf", "prometheus" or "none") and, for Prometheus,
+`METRICS_PATH`. Setting `SYNC_PROFILE_PATH` also dumps a cProfile of the run to that path.
+"""
+import cProfile
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Optional
+
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'AirtableGcalSync')
+
+
+class Metrics:
+    """ Thread-safe registry of phase timings and counters
+
+    Attributes:
+        phases: Dict mapping phase names to {"calls", "seconds", "max_seconds"}
+        counters: Dict mapping counter names to their value
+    """
+    def __init__(self):
+        self.phases = dict()
+        self.counters = dict()
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """ Clears every timing and counter, e.g. between warm Lambda invocations """
+        with self._lock:
+            self.phases = dict()
+            self.counters = dict()
+
+    def record(self, phase: str, seconds: float):
+        """ Records one timed call of a phase """
+        with self._lock:
+            timing = self.phases.setdefault(phase, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0})
+            timing["calls"] += 1
+            timing["seconds"] += seconds
+            timing["max_seconds"] = max(timing["max_seconds"], seconds)
+
+    def count(self, name: str, value: int = 1):
+        """ Increments a counter (requests, retries, payload bytes, records...) """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, phase: str):
+        """ Context manager timing the enclosed block as one call of `phase` """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    def timed(self, phase: str) -> Callable:
+        """ Decorator timing every call of the decorated function as `phase` """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(phase):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def to_emf(self, dimensions: Optional[Dict[str, str]] = None) -> list:
+        """ Formats the metrics as CloudWatch Embedded Metric Format documents
+
+        Args:
+            dimensions: (optional) Extra dimensions (e.g. {"Table": ...}) added to every document
+
+        Returns:
+            List of EMF documents: one per phase, with a `Phase` dimension, and one with the counters
+        """
+        dimensions = dimensions or dict()
+        timestamp = int(time.time() * 1000)
+
+        def document(extra_dimensions: dict, values: dict, units: dict) -> dict:
+            return dict({
+                "_aws": {
+                    "Timestamp": timestamp,
+                    "CloudWatchMetrics": [{
+                        "Namespace": METRICS_NAMESPACE,
+                        "Dimensions": [list(dimensions) + list(extra_dimensions)],
+                        "Metrics": [{"Name": name, "Unit": units[name]} for name in values],
+                    }],
+                },
+            }, **dimensions, **extra_dimensions, **values)
+
+        with self._lock:
+            documents = [
+                document({"Phase": phase},
+                         {"Duration": timing["seconds"] * 1000, "MaxDuration": timing["max_seconds"] * 1000,
+                          "Calls": timing["calls"]},
+                         {"Duration": "Milliseconds", "MaxDuration": "Milliseconds", "Calls": "Count"})
+                for phase, timing in self.phases.items()
+            ]
+            if self.counters:
+                documents.append(document({}, dict(self.counters),
+                                          {name: "Bytes" if name.endswith("bytes") else "Count"
+                                           for name in self.counters}))
+        return documents
+
+    def to_prometheus(self) -> str:
+        """ Formats the metrics in the Prometheus text exposition format """
+        def metric_name(name: str) -> str:
+            return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+        lines = [
+            "# TYPE sync_phase_seconds_total counter",
+            "# TYPE sync_phase_calls_total counter",
+            "# TYPE sync_phase_seconds_max gauge",
+        ]
+        with self._lock:
+            for phase, timing in self.phases.items():
+                lines.append('sync_phase_seconds_total{phase="%s"} %f' % (phase, timing["seconds"]))
+                lines.append('sync_phase_calls_total{phase="%s"} %d' % (phase, timing["calls"]))
+                lines.append('sync_phase_seconds_max{phase="%s"} %f' % (phase, timing["max_seconds"]))
+            for name, value in self.counters.items():
+                lines.append("# TYPE sync_%s_total counter" % metric_name(name))
+                lines.append("sync_%s_total %d" % (metric_name(name), value))
+        return "\n".join(lines) + "\n"
+
+    def export(self, dimensions: Optional[Dict[str, str]] = None):
+        """ Exports the metrics in the configured `METRICS_FORMAT` (EMF to stdout by default) """
+        metrics_format = os.getenv('METRICS_FORMAT', 'emf')
+        if metrics_format == 'emf':
+            for document in self.to_emf(dimensions):
+                print(json.dumps(document))
+        elif metrics_format == 'prometheus':
+            path = os.getenv('METRICS_PATH', 'sync.prom')
+            with open(path + '.tmp', 'w') as metrics_file:
+                metrics_file.write(self.to_prometheus())
+            os.replace(path + '.tmp', path)
+
+
+# registry shared by every module of a sync run
+metrics = Metrics()
+
+
+@contextmanager
+def profiled(path: Optional[str] = None):
+    """ Profiles the enclosed block with cProfile when a path (or `SYNC_PROFILE_PATH`) is set
+
+    Args:
+        path: (optional) File to dump the profile stats to, readable with :mod:`pstats`
+    """
+    path = path or os.getenv('SYNC_PROFILE_PATH')
+    if not path:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
@@ -0,0 +1,296 @@
+""" reconcile.py
+
+This module checks a whole Airtable table against its Google Calendar in bulk: the calendar is
+listed page by page (see :meth:`calendar_request.Calendar.list_events`) into an in-memory
+:obj:`EventIndex`, and every record is diffed against it in one pass, so a check costs
+O(pages) API calls rather than one `get_event` per record.
+
+Three kinds of discrepancies are reported, and fixed with `--repair`:
+    - missing: synced records whose event does not exist (anymore)
+    - orphaned: events tagged with a record id that no record links to
+    - drifted: events whose title or start date differ from the last synced state of their
+      record (`lastName`, `lastDeadline`)
+
+Records are compared with their last synced state, so that the edits the next sync will carry
+over (in either direction) are not mistaken for drift. Likewise, events moved in Gcal since the
+stored sync token are reported as pending rather than drifted, and left alone by `--repair`.
+
+Usage:
+    python reconcile.py [--repair] [--since YYYY-MM-DD] [--until YYYY-MM-DD]
+"""
+import argparse
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from googleapiclient.errors import HttpError
+
+from airtable_request import (AirtableTable, default_table, failed_records, get_table, iter_records,
+                              send_nonempty_payload, update_payload_state)
+from calendar_request import MERGE_FIELDS, Calendar, parse_event_time, record_id_of
+from metrics import metrics
+from record_model import Event
+from rule_pipeline import DEADLINE_START
+from snapshot_cache import get_snapshot_cache
+from state_store import get_state_store
+from sync_script import index_calendar_changes, load_sync_config
+
+
+class EventIndex:
+    """ In-memory index of a calendar's events, kept as compact :obj:`record_model.Event`
+
+    Attributes:
+        by_id: Dict mapping event ids to events
+        by_record: Dict mapping Airtable record ids to the events tagged with them
+    """
+    def __init__(self, events: Iterable[Dict]):
+        self.by_id = dict()
+        self.by_record = dict()
+        for event in events:
+            if event.get('status') == 'cancelled':
+                continue
+            event = Event.from_api(event, record_id_of(event))
+            self.by_id[event.id] = event
+            if event.record_id:
+                self.by_record.setdefault(event.record_id, []).append(event)
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+
+class ReconcileReport:
+    """ Discrepancies found between a table and its calendar
+
+    Attributes:
+        missing: Dict mapping the ids of the active records without an existing event to the
+            (title, start, duration) of the event to create
+        orphaned: Events (:obj:`record_model.Event`) tagged with a record id, but not linked from that record
+        drifted: Dict mapping record ids to (event id, changes), the changes being the keyword
+            arguments of :meth:`calendar_request.Calendar.patch_event` that bring the event in line
+        relinked: Dict mapping record ids to the id of their tagged event, for records whose
+            `calendarEventId` is unset or stale while the event itself exists
+        pending: Dict mapping record ids to the id of their event, for events moved in Gcal that
+            the next sync will carry over to the record (see :func:`sync_script.process_calendar_change`)
+        checked: Number of records compared with the calendar
+    """
+    def __init__(self):
+        self.missing = dict()
+        self.orphaned = []
+        self.drifted = dict()
+        self.relinked = dict()
+        self.pending = dict()
+        self.checked = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.missing or self.orphaned or self.drifted or self.relinked)
+
+    def summary(self) -> str:
+        return (f'{self.checked} records checked: {len(self.missing)} missing, {len(self.orphaned)} orphaned, '
+                f'{len(self.drifted)} drifted, {len(self.relinked)} relinked, {len(self.pending)} pending events')
+
+
+def get_linked_records(table: Optional[AirtableTable] = None) -> Iterator[Dict]:
+    """ Streams every synced record, including the inactive (done) ones that still own an event
+
+    Args:
+        table: (optional) The :obj:`airtable_request.AirtableTable` to query, instead of the default table
+
+    Returns:
+        Iterator over the records
+    """
+    params = {"fields[]": ["lastName", "lastDeadline", "lastStatus", "calendarEventId", "duration"],
+              "filterByFormula": "NOT({lastDeadline}='')"}
+    return iter_records(params, table)
+
+
+def diff_record(fields: Dict, start: datetime, event: Event) -> Dict:
+    """ Returns the :meth:`calendar_request.Calendar.patch_event` arguments bringing an event in line with its record
+
+    Only the date of the event is synced (see :func:`sync_script.process_calendar_change`): a
+    time of day or length set in Gcal is kept, both when comparing and when moving the event back
+    to its record's date.
+
+    Args:
+        fields: The record's fields
+        start: The event start of the record's `lastDeadline`
+        event: The record's event
+
+    Returns:
+        Dict of the changes to patch, empty if the event is in line
+    """
+    changes = dict()
+    name = fields.get("lastName")
+    if name and event.summary != name:
+        changes['title'] = name
+
+    event_start = parse_event_time(event.start)
+    event_end = parse_event_time(event.end)
+    if event_start is None or event_end is None:
+        changes.update({'start': start, 'duration': fields.get("duration") or 1})
+    elif event_start.date() != start.date():
+        changes.update({'start': datetime.combine(start.date(), event_start.time()),
+                        'duration': (event_end - event_start) / timedelta(hours=1)})
+    return changes
+
+
+def reconcile(calendar: Calendar, records: Iterable[Dict], time_min: Optional[datetime] = None,
+              time_max: Optional[datetime] = None, pending_changes: Optional[Dict] = None) -> ReconcileReport:
+    """ Diffs every record against an index of the calendar's events
+
+    Only the records whose (last synced) deadline falls within [`time_min`, `time_max`) are compared, as the
+    calendar is only listed within that window. The few linked events that are not found in
+    the window (e.g. moved outside of it) are looked up individually before being reported missing.
+
+    Events moved in Gcal whose change the sync has not processed yet are reported as pending
+    instead of drifted, as the next sync brings their new start over to Airtable.
+
+    Args:
+        calendar: The :obj:`calendar_request.Calendar` of the table
+        records: Records as returned by :func:`get_linked_records`
+        time_min: (optional) Start of the window to check
+        time_max: (optional) End of the window to check
+        pending_changes: (optional) The calendar changes not synced yet, as returned by
+            :func:`sync_script.index_calendar_changes`
+
+    Returns:
+        The :obj:`ReconcileReport` of the discrepancies
+    """
+    with metrics.timer('reconcile.index'):
+        index = EventIndex(calendar.list_events(time_min, time_max))
+    print(f'Indexed {len(index)} events')
+    pending_changes = pending_changes or dict()
+
+    report = ReconcileReport()
+    linked_event_ids = set()
+    for record in records:
+        fields = record.get('fields', {})
+        event_id = fields.get("calendarEventId")
+        if event_id:
+            linked_event_ids.add(event_id)
+        if fields.get("lastStatus") == "Done" or not fields.get("lastDeadline"):
+            continue
+        start = datetime.strptime(fields["lastDeadline"][0:10], "%Y-%m-%d") + DEADLINE_START
+        if (time_min and start < time_min.replace(tzinfo=None)) or \
+                (time_max and start >= time_max.replace(tzinfo=None)):
+            continue
+        report.checked += 1
+
+        event = index.by_id.get(event_id) if event_id else None
+        if event is None and event_id and (time_min or time_max):
+            event = lookup_event(calendar, event_id)
+        if event is None:
+            tagged = index.by_record.get(record['id'])
+            if not tagged:
+                report.missing[record['id']] = (fields.get("lastName"), start, fields.get("duration") or 1)
+                continue
+            event = tagged[0]
+            report.relinked[record['id']] = event.id
+            linked_event_ids.add(event.id)
+
+        changes = diff_record(fields, start, event)
+        if 'start' in changes and record['id'] in pending_changes:
+            report.pending[record['id']] = event.id
+            changes = {key: value for key, value in changes.items() if key not in ('start', 'duration')}
+        if changes:
+            report.drifted[record['id']] = (event.id, changes)
+
+    report.orphaned = [event for record_events in index.by_record.values() for event in record_events
+                       if event.id not in linked_event_ids]
+    metrics.count('reconcile.checked', report.checked)
+    return report
+
+
+def lookup_event(calendar: Calendar, event_id: str) -> Optional[Event]:
+    """ Gets a single event, returning None when it was deleted """
+    try:
+        event = calendar.get_event(event_id, fields=MERGE_FIELDS)
+    except HttpError as error:
+        if error.resp.status in (404, 410):
+            return None
+        raise
+    return None if event.get('status') == 'cancelled' else Event.from_api(event, record_id_of(event))
+
+
+def repair(calendar: Calendar, report: ReconcileReport, table: Optional[AirtableTable] = None) -> List:
+    """ Fixes the discrepancies of a report
+
+    Missing events are created, orphaned events deleted, drifted events patched, and the
+    records' `calendarEventId` updated where needed. Pending events are left to the next sync.
+    Gcal writes are batched when the calendar is in batched mode.
+
+    Args:
+        calendar: The :obj:`calendar_request.Calendar` of the table
+        report: The :obj:`ReconcileReport` returned by :func:`reconcile`
+        table: (optional) The :obj:`airtable_request.AirtableTable` to write to, instead of the default table
+
+    Returns:
+        The (payload, error) pairs of the Airtable requests that failed, plus a single-record pair
+        for every record whose Gcal write failed
+    """
+    record_updates = {record_id: {"calendarEventId": event_id} for record_id, event_id in report.relinked.items()}
+
+    for record_id, (title, start, duration) in report.missing.items():
+        def store_event_id(created_event, record_id=record_id):
+            record_updates[record_id] = {"calendarEventId": created_event['id']}
+
+        calendar.create_event(title, start, record_id, duration=duration, callback=store_event_id)
+
+    for event in report.orphaned:
+        calendar.delete_event(event.id)
+
+    for record_id, (event_id, changes) in report.drifted.items():
+        # sent as is, since the snapshot cache believes these events are up to date
+        def remember(patched_event, record_id=record_id, event_id=event_id, changes=changes):
+            if calendar.snapshot_cache:
+                calendar.snapshot_cache.update(record_id, event_id, changes, patched_event.get('etag'))
+
+        calendar.patch_event(event_id, record_id, callback=remember, **changes)
+    calendar.flush()
+
+    payload = {"records": [], "typecast": True}
+    for record_id, fields in record_updates.items():
+        payload = update_payload_state(payload, 'patch', table)
+        payload['records'].append({"id": record_id, "fields": fields})
+    failed = send_nonempty_payload(payload, 'patch', table)
+    return failed + [({"records": [{"id": record_id, "fields": {}}]}, error)
+                     for record_id, error in calendar.failed.items()]
+
+
+def reconcile_table(calendar_id: str, table: Optional[AirtableTable] = None, time_min: Optional[datetime] = None,
+                    time_max: Optional[datetime] = None, fix: bool = False) -> ReconcileReport:
+    """ Reconciles a (table, calendar) pair, optionally repairing it
+
+    Args:
+        calendar_id: The Gcal UUID of the pair
+        table: (optional) The :obj:`airtable_request.AirtableTable` of the pair, instead of the default table
+        time_min: (optional) Start of the window to check
+        time_max: (optional) End of the window to check
+        fix: (optional) If True, repair the discrepancies found
+
+    Returns:
+        The :obj:`ReconcileReport` of the discrepancies found
+    """
+    table = table or default_table
+    calendar = Calendar(calendar_id, batch=True, snapshot_cache=get_snapshot_cache())
+    state_store = get_state_store()
+    # the sync token is not saved, so the next sync still processes these changes
+    pending_changes = index_calendar_changes(calendar.list_changes(state_store)) if state_store else None
+    report = reconcile(calendar, get_linked_records(table), time_min, time_max, pending_changes)
+    print(f'{table.base_name}/{table.table_name}: {report.summary()}')
+
+    if fix and report:
+        failed = repair(calendar, report, table)
+        if failed:
+            print(f'Repair failed for {len(failed_records(failed))} records')
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--repair', action='store_true', help='fix the discrepancies found')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='only check deadlines from this date')
+    parser.add_argument('--until', type=datetime.fromisoformat, help='only check deadlines before this date')
+    args = parser.parse_args()
+
+    for pair in load_sync_config():
+        reconcile_table(pair["calendar_id"], get_table(pair["base"], pair["table"]), args.since, args.until,
+                        fix=args.repair)
@@ -0,0 +1,172 @@
+""" record_model.py
+
+This module provides the compact in-memory model of the Airtable records and Gcal events a sync
+holds on to. Large active sets are held for a whole run (e.g. by :obj:`scheduler.TimeBudget`, to
+prioritize them), so instead of the nested dicts of the API responses each record is a
+`__slots__` object: deadlines are stored as date ordinals, statuses as small interned codes and
+event colors as small ints.
+
+API responses are parsed with orjson when it is installed (straight from the response bytes),
+and with the standard json module otherwise; :func:`dumps` serializes request bodies the same way.
+"""
+import json
+import sys
+import threading
+from datetime import date
+from functools import lru_cache
+from operator import attrgetter
+from typing import Callable, Dict, Optional
+
+from funcy import get_in
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+STATUSES = [None, "Todo", "In Progress", "Done", "Abandoned"]  # status names by code, unknown ones are appended
+_status_codes = {status: code for code, status in enumerate(STATUSES)}
+_status_lock = threading.Lock()
+
+DONE = _status_codes["Done"]
+ABANDONED = _status_codes["Abandoned"]
+
+
+def loads(content: bytes):
+    """ Parses a JSON response body, with orjson if installed """
+    return orjson.loads(content) if orjson else json.loads(content)
+
+
+def dumps(value) -> bytes:
+    """ Serializes a JSON request body, with orjson if installed """
+    return orjson.dumps(value) if orjson else json.dumps(value).encode()
+
+
+def status_code(status: Optional[str]) -> int:
+    """ Returns the small int code of a `Status`, registering statuses seen for the first time """
+    code = _status_codes.get(status)
+    if code is None:
+        with _status_lock:
+            code = _status_codes.setdefault(status, len(STATUSES))
+            if code == len(STATUSES):
+                STATUSES.append(status)
+    return code
+
+
+@lru_cache(maxsize=4096)
+def to_ordinal(value: Optional[str]) -> int:
+    """ Returns the (shared) date ordinal of a date (or dateTime) string, 0 when unset """
+    return date.fromisoformat(value[0:10]).toordinal() if value else 0
+
+
+@lru_cache(maxsize=4096)
+def iso_date(ordinal: int) -> Optional[str]:
+    """ Returns the (shared) YYYY-MM-DD string of a date ordinal, None for 0 """
+    return date.fromordinal(ordinal).isoformat() if ordinal else None
+
+
+def intern_value(value: Optional[str]) -> Optional[str]:
+    """ Interns the values of low-cardinality fields (e.g. `Deadline Group`), so records share them """
+    return sys.intern(value) if value else None
+
+
+class Record:
+    """ Active Airtable record, holding the fields the sync rules read
+
+    Attributes:
+        id: Airtable record id
+        name: `Name`
+        deadline: `Deadline` as a date ordinal, 0 when unset
+        status: `Status` code (see :func:`status_code`)
+        deadline_group: `Deadline Group`
+        event_id: `calendarEventId`
+        duration: `duration` in hours
+        last_deadline: `lastDeadline` as a date ordinal, 0 when unset
+        last_calendar_deadline: `lastCalendarDeadline` dateTime
+        last_name: `lastName`
+    """
+    __slots__ = ('id', 'name', 'deadline', 'status', 'deadline_group', 'event_id', 'duration',
+                 'last_deadline', 'last_calendar_deadline', 'last_name')
+
+    def __init__(self, id: str, name: Optional[str] = None, deadline: int = 0, status: int = 0,
+                 deadline_group: Optional[str] = None, event_id: Optional[str] = None, duration=None,
+                 last_deadline: int = 0, last_calendar_deadline: Optional[str] = None,
+                 last_name: Optional[str] = None):
+        self.id = id
+        self.name = name
+        self.deadline = deadline
+        self.status = status
+        self.deadline_group = deadline_group
+        self.event_id = event_id
+        self.duration = duration
+        self.last_deadline = last_deadline
+        self.last_calendar_deadline = last_calendar_deadline
+        self.last_name = last_name
+
+    @classmethod
+    def from_api(cls, record: Dict) -> 'Record':
+        """ Builds a record from a record of an Airtable list response ({"id", "fields"})
+
+        A synced record's `lastName` is the same string as its `Name`, so it is shared rather than kept twice.
+        """
+        fields = record.get('fields', {})
+        name = fields.get("Name")
+        last_name = fields.get("lastName")
+        return cls(record['id'], name, to_ordinal(fields.get("Deadline")),
+                   status_code(fields.get("Status")), intern_value(fields.get("Deadline Group")),
+                   fields.get("calendarEventId"), fields.get("duration"), to_ordinal(fields.get("lastDeadline")),
+                   fields.get("lastCalendarDeadline"), name if last_name == name else last_name)
+
+    def get(self, field: str, default=None):
+        """ Returns the API value of a field (e.g. `Deadline` as YYYY-MM-DD), or `default` if it is unset """
+        value = FIELD_GETTERS[field](self)
+        return default if value is None else value
+
+    def __repr__(self) -> str:
+        return f'Record({self.id!r}, {self.name!r}, {iso_date(self.deadline)!r}, {STATUSES[self.status]!r})'
+
+
+# API value of each field of a Record, by Airtable field name
+FIELD_GETTERS: Dict[str, Callable[[Record], object]] = {
+    "Name": attrgetter('name'),
+    "Deadline": lambda record: iso_date(record.deadline),
+    "Status": lambda record: STATUSES[record.status],
+    "Deadline Group": attrgetter('deadline_group'),
+    "calendarEventId": attrgetter('event_id'),
+    "duration": attrgetter('duration'),
+    "lastDeadline": lambda record: iso_date(record.last_deadline),
+    "lastCalendarDeadline": attrgetter('last_calendar_deadline'),
+    "lastName": attrgetter('last_name'),
+}
+
+
+class Event:
+    """ Gcal event, holding what is needed to compare it with its record
+
+    Attributes:
+        id: Gcal event id
+        summary: Title of the event
+        start: Start dateTime, None for all-day events
+        end: End dateTime, None for all-day events
+        color_id: Gcal `colorId` as an int, 0 for the calendar's color
+        record_id: Id of the Airtable record the event was created for, None if untagged
+    """
+    __slots__ = ('id', 'summary', 'start', 'end', 'color_id', 'record_id')
+
+    def __init__(self, id: str, summary: Optional[str] = None, start: Optional[str] = None,
+                 end: Optional[str] = None, color_id: int = 0, record_id: Optional[str] = None):
+        self.id = id
+        self.summary = summary
+        self.start = start
+        self.end = end
+        self.color_id = color_id
+        self.record_id = record_id
+
+    @classmethod
+    def from_api(cls, event: Dict, record_id: Optional[str] = None) -> 'Event':
+        """ Builds an event from a Gcal event resource, tagged with the id of its record if any """
+        return cls(event['id'], event.get('summary'), get_in(event, ['start', 'dateTime']),
+                   get_in(event, ['end', 'dateTime']), int(event.get('colorId') or 0), record_id)
+
+    def __repr__(self) -> str:
+        return f'Event({self.id!r}, {self.summary!r}, {self.start!r})'
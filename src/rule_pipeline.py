@@ -0,0 +1,144 @@
+""" rule_pipeline.py
+
+This module parses pages of Airtable records into columns, computing the deadline-derived values
+(`Deadline Group`, `Day`, 16:00 start, "Today" flag) in one pass per page, and holds the registry
+of sync rules that run over them.
+"""
+from datetime import date, datetime, timedelta
+from typing import Callable, Iterator, List, Optional
+
+from record_model import FIELD_GETTERS, Record
+
+DAY_OF_WEEK = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+DEADLINE_START = timedelta(hours=16)  # events start at 16:00 on the deadline
+TODAY_OFFSET = timedelta(hours=7)  # the "Today" deadline group rolls over at 07:00 UTC
+
+RULES = []
+
+
+def register_rule(rule: Callable) -> Callable:
+    """ Decorator registering a sync rule, run by :func:`sync_script.update_records` in registration order
+
+    Rules are called as `rule(update_fields, row, calendar)` and return the updated `update_fields`.
+    """
+    RULES.append(rule)
+    return rule
+
+
+def parse_deadline(deadline: str, today: date) -> tuple:
+    """ Computes the deadline-derived values of a `Deadline` string (YYYY-MM-DD)
+
+    Args:
+        deadline: The `Deadline` field
+        today: The current date, as seen by the "Today" deadline group
+
+    Returns:
+        Tuple of (16:00 start datetime, `Deadline Group` week ending "MM/DD", `Day` "Mon"..."Sun", is today)
+    """
+    start = datetime.strptime(deadline, "%Y-%m-%d") + DEADLINE_START
+    weekday = start.weekday()
+    next_sunday = (start + timedelta(days=6 - weekday)).strftime("%m/%d")
+    return start, next_sunday, DAY_OF_WEEK[weekday], start.date() == today
+
+
+class RecordPage:
+    """ Columnar representation of a page of Airtable records
+
+    Every field is stored as a column (list) indexed by row, and the deadline-derived columns
+    are computed once per distinct deadline in the page.
+
+    Attributes:
+        ids: Airtable record ids
+        columns: Dict mapping field names to their column of values (None when unset)
+        calendar_starts: Start dateTime of each record's event when it changed in Gcal, else None
+        deadline_starts: 16:00 start datetime of each deadline
+        deadline_groups: `Deadline Group` (week ending "MM/DD") of each deadline
+        days: `Day` ("Mon"..."Sun") of each deadline
+        is_today: Whether each deadline is today
+    """
+    def __init__(self, records: List[Record], calendar_changes: Optional[dict] = None, today: Optional[date] = None):
+        """ Parses a page of records
+
+        Args:
+            records: The :obj:`record_model.Record` of the page
+            calendar_changes: (optional) Changed event start times by record id
+            today: (optional) The current date, defaulting to the "Today" group's date
+        """
+        self.today = today or (datetime.today() - TODAY_OFFSET).date()
+        self.ids = [record.id for record in records]
+        self.columns = {field: [get(record) for record in records] for field, get in FIELD_GETTERS.items()}
+
+        calendar_changes = calendar_changes or dict()
+        self.calendar_starts = [calendar_changes.get(record_id) for record_id in self.ids]
+        self._derive_deadlines()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator['RecordRow']:
+        return (RecordRow(self, index) for index in range(len(self.ids)))
+
+    def column(self, field: str) -> List:
+        """ Returns the column of a field, creating an empty one if no record has it set """
+        return self.columns.setdefault(field, [None] * len(self.ids))
+
+    def _derive_deadlines(self):
+        """ Computes the deadline-derived columns, parsing each distinct deadline once """
+        deadlines = self.column('Deadline')
+        parsed = {deadline: parse_deadline(deadline, self.today) for deadline in set(deadlines) if deadline}
+        derived = [parsed.get(deadline, (None, None, None, False)) for deadline in deadlines]
+        self.deadline_starts, self.deadline_groups, self.days, self.is_today = (
+            [list(column) for column in zip(*derived)] if derived else ([], [], [], []))
+
+    def set(self, index: int, field: str, value):
+        """ Updates a field of a row, recomputing its derived columns when the `Deadline` changes """
+        self.column(field)[index] = value
+        if field == 'Deadline':
+            start, group, day, is_today = parse_deadline(value, self.today) if value else (None, None, None, False)
+            self.deadline_starts[index] = start
+            self.deadline_groups[index] = group
+            self.days[index] = day
+            self.is_today[index] = is_today
+
+
+class RecordRow:
+    """ View of a single record of a :obj:`RecordPage` """
+    __slots__ = ('page', 'index')
+
+    def __init__(self, page: RecordPage, index: int):
+        self.page = page
+        self.index = index
+
+    @property
+    def id(self) -> str:
+        return self.page.ids[self.index]
+
+    def get(self, field: str, default=None):
+        """ Returns the value of a field, or `default` if it is unset """
+        column = self.page.columns.get(field)
+        value = column[self.index] if column is not None else None
+        return default if value is None else value
+
+    def set(self, field: str, value):
+        """ Updates the value of a field (see :meth:`RecordPage.set`) """
+        self.page.set(self.index, field, value)
+
+    @property
+    def calendar_start(self) -> Optional[str]:
+        return self.page.calendar_starts[self.index]
+
+    @property
+    def deadline_start(self) -> Optional[datetime]:
+        return self.page.deadline_starts[self.index]
+
+    @property
+    def deadline_group(self) -> Optional[str]:
+        return self.page.deadline_groups[self.index]
+
+    @property
+    def day(self) -> Optional[str]:
+        return self.page.days[self.index]
+
+    @property
+    def is_today(self) -> bool:
+        return self.page.is_today[self.index]
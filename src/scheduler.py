@@ -0,0 +1,143 @@
+""" scheduler.py
+
+This module schedules the records of a sync run within a time budget, e.g. the time left in a
+Lambda invocation. Records are dispatched by priority (done/abandoned transitions, today's
+deadlines, new records, renames, then everything else), and dispatching stops once the
+estimated cost of the next record no longer fits before the deadline. The records left over are
+carried over to the next run (see :func:`sync_script.sync`).
+
+Records are prioritized within a look-ahead window of LOOKAHEAD records read from the stream,
+rather than over the whole table, so the first records are processed as soon as the first page
+is in, and memory does not grow with the table.
+"""
+import heapq
+import itertools
+import os
+import time
+from datetime import date, datetime
+from typing import Iterable, Iterator, Optional
+
+from metrics import metrics
+from record_model import ABANDONED, DONE, Record
+from rule_pipeline import TODAY_OFFSET
+
+DEADLINE_MARGIN = float(os.getenv('SYNC_DEADLINE_MARGIN_SECONDS', 10))  # kept for the final flushes
+DEFAULT_RECORD_COST = 0.02  # seconds per record, until a run has been timed
+COST_SMOOTHING = 0.3  # weight of the latest page in the moving average of the record cost
+PAGE_SIZE = 10  # records processed at a time, small so that the cost estimate catches up quickly
+UNSUBMITTED_REQUESTS = 6  # Airtable requests for a full Gcal batch of staged records, plus the open payload
+LOOKAHEAD = int(os.getenv('SCHEDULER_LOOKAHEAD_RECORDS', 100))  # records read ahead to pick the next by priority
+
+PRIORITY_DONE, PRIORITY_TODAY, PRIORITY_NEW, PRIORITY_RENAME, PRIORITY_OTHER = range(5)
+
+_record_costs = dict()  # recent record costs by table, kept across warm invocations
+
+
+def priority(record: Record, today: int) -> int:
+    """ Priority of a record's work, lower first
+
+    Args:
+        record: The :obj:`record_model.Record`
+        today: Ordinal of the current date, as seen by the "Today" deadline group
+
+    Returns:
+        One of PRIORITY_DONE, PRIORITY_TODAY, PRIORITY_NEW, PRIORITY_RENAME or PRIORITY_OTHER
+    """
+    if record.status == DONE or record.status == ABANDONED:
+        return PRIORITY_DONE
+    if record.deadline == today:
+        return PRIORITY_TODAY
+    if not record.last_deadline:
+        return PRIORITY_NEW
+    if record.name != record.last_name:
+        return PRIORITY_RENAME
+    return PRIORITY_OTHER
+
+
+class TimeBudget:
+    """ Dispatches records by priority until a deadline
+
+    The cost of a record is a moving average of the time taken by the pages processed so far
+    (including the Gcal batches they flushed), seeded with the cost seen by the previous run of
+    the same table. Enough time is kept to flush the last Gcal batch and the writer's queued
+    Airtable requests.
+
+    Attributes:
+        deadline: `time.monotonic()` time by which the run must be over
+        name: Name of the table, under which the record cost is remembered
+        margin: Seconds kept for the final flushes
+        writer: (optional) The table's :obj:`airtable_request.AirtableWriter`, whose queue must drain in time
+        cost: Estimated seconds per record
+        leftover: Ids of the records that were not dispatched
+    """
+    def __init__(self, deadline: float, name: str = '', margin: float = DEADLINE_MARGIN, writer=None):
+        self.deadline = deadline
+        self.name = name
+        self.margin = margin
+        self.writer = writer
+        self.cost = _record_costs.get(name, DEFAULT_RECORD_COST)
+        self.leftover = []
+        self._dispatched = 0
+        self._completed = 0
+
+    def remaining(self) -> float:
+        """ Seconds left before the deadline """
+        return self.deadline - time.monotonic()
+
+    def allows(self) -> bool:
+        """ Whether one more record fits, on top of the dispatched records not processed yet """
+        reserve = self.margin + (self.writer.drain_time(UNSUBMITTED_REQUESTS) if self.writer else 0)
+        return self.remaining() - reserve > self.cost * (self._dispatched - self._completed + 1)
+
+    def observe(self, records: int, seconds: float):
+        """ Records the time taken to process a page of dispatched records """
+        self._completed += records
+        if records:
+            self.cost += COST_SMOOTHING * (seconds / records - self.cost)
+            _record_costs[self.name] = self.cost
+
+    def dispatch(self, records: Iterable[Record], today: Optional[date] = None,
+                 lookahead: int = LOOKAHEAD) -> Iterator[Record]:
+        """ Yields records by priority, as long as they fit in the budget
+
+        The records are streamed through a window of `lookahead` records, out of which the most
+        urgent one is dispatched each time. Once the budget is spent, the rest of the stream is
+        still read, so that every record left over is carried over to the next run.
+
+        Args:
+            records: The :obj:`record_model.Record` to schedule
+            today: (optional) The current date, defaulting to the "Today" group's date
+            lookahead: (optional) Number of records read ahead of the one dispatched
+
+        Returns:
+            Iterator over the dispatched records
+        """
+        today = (today or (datetime.today() - TODAY_OFFSET).date()).toordinal()
+        window = []  # heap of (priority, arrival, record), so records keep the Airtable order within a priority
+        arrivals = itertools.count()
+        spent = False
+        for record in records:
+            if spent:
+                self.leftover.append(record.id)
+                continue
+            heapq.heappush(window, (priority(record, today), next(arrivals), record))
+            if len(window) < lookahead:
+                continue
+            if not self.allows():
+                spent = True
+                self.leftover.extend(record.id for _, _, record in sorted(window))
+                window = []
+                continue
+            self._dispatched += 1
+            yield heapq.heappop(window)[2]
+
+        while window and not spent:
+            if not self.allows():
+                self.leftover.extend(record.id for _, _, record in sorted(window))
+                break
+            self._dispatched += 1
+            yield heapq.heappop(window)[2]
+
+        if self.leftover:
+            print(f'Time budget spent, {len(self.leftover)} records carried over to the next run')
+            metrics.count('records.deferred', len(self.leftover))
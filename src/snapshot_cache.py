@@ -0,0 +1,154 @@
+""" snapshot_cache.py
+
+This module provides a local SQLite cache of the last synced state of each Gcal event, used to
+skip writes whose target state is already in place, along with the event's last known `etag`.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, Optional
+
+SNAPSHOT_FIELDS = ('title', 'start', 'duration', 'color_id')
+
+
+def event_state(changes: dict) -> Dict:
+    """ Extracts the synced event state from :meth:`calendar_request.Calendar.patch_event` arguments
+
+    Args:
+        changes: Keyword arguments of a patch (title, start, duration, color_id, ...)
+
+    Returns:
+        Dict with the JSON-serializable snapshot fields present in `changes`
+    """
+    state = {key: changes[key] for key in SNAPSHOT_FIELDS if changes.get(key) is not None}
+    if 'start' in state:
+        state['start'] = state['start'].isoformat()
+        state.setdefault('duration', 1)
+    return state
+
+
+def state_hash(state: dict) -> str:
+    """ Content hash of an event state """
+    return hashlib.sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+
+class SnapshotCache:
+    """ Persistent cache of the last synced state of each event, keyed by Airtable record id
+
+    The cache is safe to share between threads.
+
+    Attributes:
+        path: Path to the SQLite database
+        connection: Open SQLite connection
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS snapshots (
+                record_id TEXT PRIMARY KEY,
+                event_id TEXT NOT NULL,
+                state TEXT NOT NULL,
+                state_hash TEXT NOT NULL,
+                etag TEXT
+            )""")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(snapshots)")]
+        if 'etag' not in columns:
+            # caches created before etags were tracked
+            self.connection.execute("ALTER TABLE snapshots ADD COLUMN etag TEXT")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS snapshots_event_id ON snapshots (event_id)")
+
+    def get(self, record_id: str) -> Optional[Dict]:
+        """ Returns the snapshot ({"event_id", "state", "state_hash", "etag"}) of a record, if cached """
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT event_id, state, state_hash, etag FROM snapshots WHERE record_id = ?", (record_id,)).fetchone()
+        if row is None:
+            return None
+        return {"event_id": row[0], "state": json.loads(row[1]), "state_hash": row[2], "etag": row[3]}
+
+    def etag(self, record_id: str, event_id: str) -> Optional[str]:
+        """ Returns the last known `etag` of a record's event, if cached """
+        snapshot = self.get(record_id)
+        return snapshot["etag"] if snapshot and snapshot["event_id"] == event_id else None
+
+    def diff(self, record_id: str, event_id: str, changes: dict) -> Dict:
+        """ Drops the changes that are already reflected in the cached event state
+
+        Args:
+            record_id: Id of the Airtable record the event belongs to
+            event_id: Id of the Gcal event
+            changes: Keyword arguments of the patch about to be sent
+
+        Returns:
+            The patch arguments that still need to be sent, or an empty dict if the target
+            state is identical to the cached one
+        """
+        snapshot = self.get(record_id)
+        if snapshot is None or snapshot["event_id"] != event_id:
+            return changes
+
+        target = event_state(changes)
+        if state_hash(dict(snapshot["state"], **target)) == snapshot["state_hash"]:
+            return dict()
+
+        differing = {key for key, value in target.items() if snapshot["state"].get(key) != value}
+        if differing & {'start', 'duration'}:
+            differing |= {'start', 'duration'}  # patch_event sends the start and end together
+        return {key: value for key, value in changes.items() if key in differing or key not in SNAPSHOT_FIELDS}
+
+    def update(self, record_id: str, event_id: str, changes: dict, etag: Optional[str] = None):
+        """ Merges written changes into the cached state of an event
+
+        Args:
+            record_id: Id of the Airtable record the event belongs to
+            event_id: Id of the Gcal event
+            changes: Keyword arguments of the create/patch that was written
+            etag: (optional) The event's `etag` after the write
+        """
+        with self._lock:
+            snapshot = self.get(record_id)
+            state = snapshot["state"] if snapshot and snapshot["event_id"] == event_id else dict()
+            state.update(event_state(changes))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO snapshots (record_id, event_id, state, state_hash, etag) VALUES (?, ?, ?, ?, ?)",
+                (record_id, event_id, json.dumps(state, sort_keys=True), state_hash(state), etag))
+
+    def invalidate(self, event_id: str, etag: Optional[str]):
+        """ Drops the snapshot of an event that was changed outside of the sync
+
+        An event listed with another `etag` than the one of the sync's last write to it was
+        modified in Gcal (or deleted) since, so its cached state can no longer be trusted to skip
+        patches.
+
+        Args:
+            event_id: Id of the listed Gcal event
+            etag: The event's current `etag`
+        """
+        with self._lock:
+            self.connection.execute(
+                "DELETE FROM snapshots WHERE event_id = ? AND (etag IS NULL OR etag != ?)", (event_id, etag or ''))
+
+    def evict(self, record_ids: Iterable[str]):
+        """ Removes the snapshots of records that are no longer active """
+        with self._lock:
+            self.connection.executemany("DELETE FROM snapshots WHERE record_id = ?", [(i,) for i in record_ids])
+
+    def save(self):
+        """ Commits the pending snapshot changes to disk """
+        with self._lock:
+            self.connection.commit()
+
+
+def get_snapshot_cache() -> Optional[SnapshotCache]:
+    """ Opens the snapshot cache configured with `SNAPSHOT_CACHE_PATH`
+
+    Returns:
+        The :obj:`SnapshotCache`, or None if no cache is configured
+    """
+    if os.getenv('SNAPSHOT_CACHE_PATH'):
+        return SnapshotCache(os.getenv('SNAPSHOT_CACHE_PATH'))
+    return None
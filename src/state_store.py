@@ -0,0 +1,102 @@
+""" state_store.py
+
+This module provides small key-value stores used to persist sync state (sync tokens, watermarks)
+between runs, either in a local JSON file or in an S3 object for AWS Lambda.
+"""
+import json
+import os
+import tempfile
+import threading
+from typing import Any, Dict, Optional
+
+
+class StateStore:
+    """ In-memory key-value store of JSON-serializable sync state
+
+    Subclasses persist the state with :meth:`save`, which is called after every :meth:`set`.
+    Stores are safe to share between threads.
+    """
+    def __init__(self, state: Optional[Dict] = None):
+        self.state = state or dict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """ Returns the stored value for `key`, or `default` if there is none """
+        return self.state.get(key, default)
+
+    def set(self, key: str, value: Any):
+        """ Stores (or deletes, when `value` is None) the value for `key` and persists the state """
+        with self._lock:
+            if value is None:
+                self.state.pop(key, None)
+            else:
+                self.state[key] = value
+            self.save()
+
+    def save(self):
+        pass
+
+
+class FileStateStore(StateStore):
+    """ State store backed by a local JSON file
+
+    Attributes:
+        path: Path to the JSON file
+    """
+    def __init__(self, path: str):
+        self.path = path
+        state = None
+        if os.path.exists(path):
+            with open(path) as state_file:
+                state = json.load(state_file)
+        super().__init__(state)
+
+    def save(self):
+        # write then rename, so an interrupted run never leaves a truncated file behind
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as state_file:
+            json.dump(self.state, state_file)
+        os.replace(state_file.name, self.path)
+
+
+class S3StateStore(StateStore):
+    """ State store backed by a JSON object in S3, for Lambda deployments
+
+    Attributes:
+        bucket: Name of the S3 bucket
+        key: Key of the JSON object
+    """
+    def __init__(self, bucket: str, key: str):
+        import boto3  # available in the Lambda runtime, not needed otherwise
+        from botocore.exceptions import ClientError
+
+        self.bucket = bucket
+        self.key = key
+        self.client = boto3.client('s3')
+
+        state = None
+        try:
+            state = json.loads(self.client.get_object(Bucket=bucket, Key=key)['Body'].read())
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'NoSuchKey':
+                raise
+        super().__init__(state)
+
+    def save(self):
+        self.client.put_object(Bucket=self.bucket, Key=self.key, Body=json.dumps(self.state).encode())
+
+
+def get_state_store() -> Optional[StateStore]:
+    """ Creates the state store configured in the environment
+
+    Uses `SYNC_STATE_BUCKET` (and optionally `SYNC_STATE_KEY`) for S3, or `SYNC_STATE_PATH`
+    for a local file.
+
+    Returns:
+        The configured :obj:`StateStore`, or None if no state store is configured
+    """
+    if os.getenv('SYNC_STATE_BUCKET'):
+        return S3StateStore(os.getenv('SYNC_STATE_BUCKET'), os.getenv('SYNC_STATE_KEY', 'sync-state.json'))
+    if os.getenv('SYNC_STATE_PATH'):
+        return FileStateStore(os.getenv('SYNC_STATE_PATH'))
+    return None
@@ -1,21 +1,42 @@
 """ sync_script.py
 
 This module provides a script to synchronize a Airtable table and a Google Calendar.
+
+Several (base, table, calendar) pairs can be synced concurrently by listing them in the JSON
+file at `SYNC_CONFIG_PATH`, e.g. `[{"base": "app...", "table": "Tasks", "calendar_id": "..."}]`.
 """
+import json
 import os
+import re
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from funcy import get_in, partial
-from typing import Dict
-
-from calendar_request import Calendar
-from airtable_request import airtable_request, update_payload_state, send_nonempty_payload
+from funcy import cat, chunks, get_in, memoize, partial
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from calendar_request import Calendar, parse_event_time, record_id_of
+from metrics import metrics, profiled
+from airtable_request import (BASE_NAME, MAX_AIRTABLE_PAGE, TABLE_NAME, AirtableTable, default_table, failed_records,
+                              get_table, iter_records, update_payload_state, send_nonempty_payload)
+from rule_pipeline import RULES, TODAY_OFFSET, RecordPage, RecordRow, register_rule
+from scheduler import PAGE_SIZE, TimeBudget
+from journal import Journal, get_journal
+from record_model import Record
+from snapshot_cache import get_snapshot_cache
+from state_store import get_state_store
 
 CALENDAR_ID = os.getenv('CALENDAR_ID')  # Airtable Tasks
-DAY_OF_WEEK = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
 GCAL_COLOR_MAPPING = {
     "Done": "5",
     "Abandoned": "11"
 } # some GCAL magic variables here
+FULL_SWEEP_INTERVAL = timedelta(hours=int(os.getenv('FULL_SWEEP_INTERVAL_HOURS', 24)))
+WATERMARK_SKEW = timedelta(minutes=1)  # margin for Airtable/Lambda clock differences
+MAX_CHANGED_RECORD_IDS = 50  # above this, a full sweep is cheaper than a long formula
+MAX_SYNC_WORKERS = int(os.getenv('MAX_SYNC_WORKERS', 8))
+RECORD_FIELDS = ["Name", "Deadline", "Status", "Deadline Group", "calendarEventId", "duration",
+                 "lastDeadline", "lastCalendarDeadline", "lastName"]  # fields the sync rules read
+RECORD_ID_PATTERN = re.compile(r'^rec[A-Za-z0-9]{14}$')  # Airtable record ids, safe to put in a formula
 
 
 def round_up_15_mins(start: datetime) -> datetime:
@@ -33,7 +54,8 @@ def round_up_15_mins(start: datetime) -> datetime:
                           microseconds=tm.microsecond)
 
 
-def get_active_records() -> Dict:
+def get_active_records(modified_since: Optional[str] = None, record_ids: Iterable[str] = (),
+                       table: Optional[AirtableTable] = None) -> Iterator[Record]:
     """ Queries Airtable API for active records
 
     Retrieves the following fields:
@@ -51,22 +73,142 @@ def get_active_records() -> Dict:
         - Deadline set (i.e. 11/27/2020)
         - lastStatus not 'Done'
 
+    In incremental mode (`modified_since` set), only the active records whose `Name`, `Deadline`
+    or `Status` were edited after the watermark are queried, along with `record_ids`. With only
+    `record_ids`, just those records are queried.
+
+    Records are streamed page by page with :func:`airtable_request.iter_records`, so there is
+    no cap on the number of active records, and parsed into the compact :obj:`record_model.Record`.
+
+    Args:
+        modified_since: (optional) ISO timestamp watermark of the last successful sync
+        record_ids: (optional) Ids of records to include regardless of the watermark, or to restrict the query to
+        table: (optional) The :obj:`airtable_request.AirtableTable` to query, instead of the default table
+
     Returns:
-        Dict with the response from Airtable for the get request
+        Iterator over the active :obj:`record_model.Record`
     """
-    fields = ["Name", "Deadline", "Status", "Deadline Group", "calendarEventId", "duration", 
-        "lastDeadline", "lastCalendarDeadline", "lastName"]
-    maxRecords = 100
     formula = "AND(NOT({Deadline}=''), NOT({lastStatus}='Done'))"
-    params = {"maxRecords": maxRecords,
-              "fields[]": fields,
+    changed = ["RECORD_ID()='%s'" % record_id for record_id in record_ids]
+    if modified_since:
+        changed.insert(0, "IS_AFTER(LAST_MODIFIED_TIME({Name}, {Deadline}, {Status}), '%s')" % modified_since)
+    if changed:
+        formula = "AND(NOT({Deadline}=''), NOT({lastStatus}='Done'), OR(%s))" % ", ".join(changed)
+    params = {"fields[]": RECORD_FIELDS,
               "filterByFormula": formula}
 
-    # TODO: Error Handling
-    return airtable_request('get', params=params).json()
+    return iter_records(params, table, Record.from_api)
+
+
+def get_watermark(state_store, now: datetime, calendar_changes: dict, key_prefix: str = "") -> Optional[str]:
+    """ Decides between an incremental fetch and a full sweep of the active records
+
+    A full sweep is needed on the first run, once per day so that :func:`transition_today_record`
+    sees every record when "Today" rolls over, every FULL_SWEEP_INTERVAL, and when too many
+    events changed in Gcal to list their records in the formula.
+
+    Args:
+        state_store: The :obj:`state_store.StateStore` holding the watermark between runs
+        now: The (UTC) start time of the current run
+        calendar_changes: Changed event start times by record id, from :func:`index_calendar_changes`
+        key_prefix: (optional) Prefix of the state keys, to keep the watermarks of several tables apart
+
+    Returns:
+        The watermark to fetch from, or None for a full sweep
+    """
+    watermark = state_store.get(key_prefix + 'airtableWatermark')
+    last_full_sweep = state_store.get(key_prefix + 'airtableFullSweep')
+    if not watermark or not last_full_sweep or len(calendar_changes) > MAX_CHANGED_RECORD_IDS:
+        return None
+
+    last_full_sweep = datetime.fromisoformat(last_full_sweep)
+    if (now - TODAY_OFFSET).date() != (last_full_sweep - TODAY_OFFSET).date():
+        return None
+    if now - last_full_sweep >= FULL_SWEEP_INTERVAL:
+        return None
+    return watermark
+
+
+def save_watermark(state_store, now: datetime, full_sweep: bool, key_prefix: str = ""):
+    """ Records a successful sync that started at `now`
+
+    Args:
+        state_store: The :obj:`state_store.StateStore` holding the watermark between runs
+        now: The (UTC) start time of the run
+        full_sweep: Whether the run fetched every active record
+        key_prefix: (optional) Prefix of the state keys, to keep the watermarks of several tables apart
+    """
+    state_store.set(key_prefix + 'airtableWatermark', (now - WATERMARK_SKEW).strftime("%Y-%m-%dT%H:%M:%S.000Z"))
+    if full_sweep:
+        state_store.set(key_prefix + 'airtableFullSweep', now.isoformat())
+
+
+def index_calendar_changes(events: list) -> Dict:
+    """ Indexes changed Gcal events by the Airtable record they were created for
+
+    Events are tagged with their record id by :meth:`calendar_request.Calendar.create_event` (see
+    :func:`calendar_request.record_id_of`). Deleted and untagged events are skipped, as are the
+    events whose tag is not a record id (anyone can edit the description in Gcal, and the record
+    ids end up in the `filterByFormula` of :func:`get_active_records`).
+
+    Args:
+        events: Changed events, as returned by :meth:`calendar_request.Calendar.list_changes`
+
+    Returns:
+        Dict mapping Airtable record ids to the event's start dateTime
+    """
+    calendar_changes = dict()
+    for event in events:
+        start = get_in(event, ['start', 'dateTime'])
+        record_id = record_id_of(event)
+        if event.get('status') == 'cancelled' or not record_id or not start or not RECORD_ID_PATTERN.match(record_id):
+            continue
+        calendar_changes[record_id] = start
+    return calendar_changes
+
+
+@register_rule
+def process_calendar_change(update_fields: dict, row: RecordRow, calendar: Calendar) -> Dict:
+    """ Detects records whose Gcal event was moved, and brings the deadline over to Airtable
 
+    A calendar change is applied when the event's date differs from `lastDeadline` while the
+    Airtable `Deadline` itself is unchanged (if both sides changed, Airtable wins). The date is
+    read in UTC, the timezone events are created in, whatever the offset Gcal lists them with.
 
-def process_new_record(update_fields: dict, record: dict, calendar: Calendar) -> Dict:
+    Note:
+        The row is updated in place, exactly as if the Gcal webhook had already written
+        `Deadline` and `lastCalendarDeadline`, so :func:`process_deadline_change` then updates
+        the derived fields without patching the event back.
+
+    Args:
+        update_fields: The payload dictionary that will be sent in a patch/post request to the Airtable API
+        row: The :obj:`rule_pipeline.RecordRow` being processed
+        calendar: The :obj:`calendar_request.Calendar` instance corresponding to the calendar out of which we're working
+
+    Returns:
+        An updated-version of `update_fields` to be sent to airtable in a patch/post request
+    """
+    calendar_start = row.calendar_start
+    calendar_date = parse_event_time(calendar_start).date().isoformat() if calendar_start else None
+    deadline = row.get("Deadline")
+    last_deadline = row.get("lastDeadline", "")
+
+    if calendar_date and last_deadline and deadline == last_deadline and calendar_date != last_deadline:
+        calendar_fields = {
+            "Deadline": calendar_date,
+            "lastCalendarDeadline": calendar_start,
+        }
+        for field, value in calendar_fields.items():
+            row.set(field, value)
+        update_fields.update(calendar_fields)
+        if calendar.snapshot_cache:
+            # the event is no longer in its last synced state
+            calendar.snapshot_cache.evict([row.id])
+    return update_fields
+
+
+@register_rule
+def process_new_record(update_fields: dict, row: RecordRow, calendar: Calendar) -> Dict:
     """ Detects and adds New Records to the update_field payload
 
     New Records are defined as:
@@ -77,109 +219,111 @@ def process_new_record(update_fields: dict, record: dict, calendar: Calendar) ->
         Events/Tasks created by the Gcal Webhook are considered New Records
 
     Does the following for New Records:
-        1. Creates the initial Gcal Event, if not already created
+        1. Creates the initial Gcal Event, if not already created (in the completed color for
+           records that are already "Done" or "Abandoned")
         2. Populates the Deadline Group field in Airtable with the week-grouping or "Today"
         3. Populates the Day field in AirTable with the correct string "Mon"..."Sun"
 
     Args:
         update_fields: The payload dictionary that will be sent in a patch/post request to the Airtable API
-        record: The individual record being processed
+        row: The :obj:`rule_pipeline.RecordRow` being processed
         calendar: The :obj:`calendar_request.Calendar` instance corresponding to the calendar out of which we're working
 
     Returns:
         An updated-version of `update_fields` to be sent to airtable in a patch/post request
     """
-    deadline = get_in(record, ["fields", "Deadline"])
-    lastDeadline = get_in(record, ["fields", "lastDeadline"])
+    deadline = row.get("Deadline")
+    lastDeadline = row.get("lastDeadline")
 
     if deadline and not lastDeadline:
-        name = get_in(record, ["fields", "Name"])
-        airtable_record_id = get_in(record, ['id'])
-        calendar_event_id = get_in(record, ["fields", "calendarEventId"])
-        deadline_date = datetime.strptime(deadline, "%Y-%m-%d") + timedelta(hours=16)
+        name = row.get("Name")
+        calendar_event_id = row.get("calendarEventId")
 
         if not calendar_event_id:
-            created_event = calendar.create_event(name, deadline_date, airtable_record_id)
-
-            update_fields.update({
-                "calendarEventId": created_event['id'],
-                "duration": 1,
-                "lastDeadline": deadline,
-            })
+            # the event id is only known once the (possibly batched) insert has been sent
+            def store_event_id(created_event):
+                update_fields.update({
+                    "calendarEventId": created_event['id'],
+                    "duration": 1,
+                    "lastDeadline": deadline,
+                })
+
+            calendar.create_event(name, row.deadline_start, row.id, callback=store_event_id,
+                                  color_id=GCAL_COLOR_MAPPING.get(row.get("Status")))
     return update_fields
 
 
-def process_deadline_change(update_fields: dict, record: dict, calendar: Calendar) -> Dict:
+@register_rule
+def process_deadline_change(update_fields: dict, row: RecordRow, calendar: Calendar) -> Dict:
     """ Detects records where the `Deadline` changed and updates the update_field payload accordingly
 
     A deadline change is detected when the `deadline` does not equal the `lastDeadline` field.
 
     Actions:
-        1. Updates the Gcal event, if the detected deadline change did not originate from the webhook
+        1. Stages a Gcal event update, if the detected deadline change did not originate from the webhook
         2. Update the `Deadline Group`, `Day`, and `lastDeadline` fields in Airtable
 
     Args:
         update_fields: The payload dictionary that will be sent in a patch/post request to the Airtable API
-        record: The individual record being processed
+        row: The :obj:`rule_pipeline.RecordRow` being processed
         calendar: The :obj:`calendar_request.Calendar` instance corresponding to the calendar out of which we're working
 
     Returns:
         An updated-version of `update_fields` to be sent to airtable in a patch/post request
     """
-    deadline = get_in(record, ["fields", "Deadline"])
-    last_deadline = get_in(record, ["fields", "lastDeadline"], "")
+    deadline = row.get("Deadline")
+    last_deadline = row.get("lastDeadline", "")
 
     if deadline != last_deadline:
-        calendar_event_id = get_in(record, ["fields", "calendarEventId"])
-        duration = get_in(record, ["fields", "duration"])
-        lastCalendarDeadline = get_in(record, ["fields", "lastCalendarDeadline"], "")[0:10]
-        airtable_record_id = get_in(record, ["id"])
-        deadline_date = datetime.strptime(deadline, "%Y-%m-%d") + timedelta(hours=16)
-        days_to_sunday = 6 - deadline_date.weekday()
-        next_sunday = (deadline_date + timedelta(days=days_to_sunday)).strftime("%m/%d")
+        calendar_event_id = row.get("calendarEventId")
+        duration = row.get("duration")
+        lastCalendarDeadline = row.get("lastCalendarDeadline")
+        if lastCalendarDeadline:
+            # in UTC, like the date process_calendar_change read from it
+            lastCalendarDeadline = parse_event_time(lastCalendarDeadline).date().isoformat()
 
         if not duration:
             duration = 1
 
         # valid calendar_event_id; and wasn't recently updated by gcal webhook
         if calendar_event_id and lastCalendarDeadline != deadline:
-            calendar.patch_event(calendar_event_id, airtable_record_id, start=deadline_date, duration=duration)
+            calendar.stage_patch(calendar_event_id, row.id, start=row.deadline_start, duration=duration)
         
         update_fields.update({
-            "Deadline Group": next_sunday, 
-            "Day": DAY_OF_WEEK[deadline_date.weekday()],
+            "Deadline Group": row.deadline_group, 
+            "Day": row.day,
             "lastDeadline": deadline
         })
     return update_fields
 
 
-def process_name_change(update_fields: dict, record: dict, calendar: Calendar) -> Dict:
+@register_rule
+def process_name_change(update_fields: dict, row: RecordRow, calendar: Calendar) -> Dict:
     """ Detects records where the `Name` changed and updates the update_field payload accordingly
 
     A deadline change is detected when the `Name` does not equal the `lastName` field.
 
     Actions:
-        1. Updates the Gcal event
+        1. Stages a Gcal event update
         2. Update the `lastName` field in Airtable
 
     Args:
         update_fields: The payload dictionary that will be sent in a patch/post request to the Airtable API
-        record: The individual record being processed
+        row: The :obj:`rule_pipeline.RecordRow` being processed
         calendar: The :obj:`calendar_request.Calendar` instance corresponding to the calendar out of which we're working
 
     Returns:
         An updated-version of `update_fields` to be sent to airtable in a patch/post request
     """
-    name = get_in(record, ["fields", "Name"])
-    last_name = get_in(record, ["fields", "lastName"], "")
+    name = row.get("Name")
+    last_name = row.get("lastName", "")
 
     if name != last_name:
-        airtable_record_id = get_in(record, ['id'])
-        calendar_event_id = get_in(record, ["fields", "calendarEventId"])
+        calendar_event_id = row.get("calendarEventId")
 
         # valid calendar_event_id
         if calendar_event_id:
-            calendar.patch_event(calendar_event_id, airtable_record_id, title=name)
+            calendar.stage_patch(calendar_event_id, row.id, title=name)
         
         print(f'new_name: {name}')
         update_fields.update({
@@ -188,7 +332,8 @@ def process_name_change(update_fields: dict, record: dict, calendar: Calendar) -
     return update_fields
 
 
-def transition_today_record(update_fields: dict, record: dict) -> Dict:
+@register_rule
+def transition_today_record(update_fields: dict, row: RecordRow, calendar: Calendar) -> Dict:
     """ Transitions records with a deadline that corresponds to the current date
     
     Basically detects whether the `deadline` matches Today's actual date, and updates the
@@ -196,47 +341,45 @@ def transition_today_record(update_fields: dict, record: dict) -> Dict:
 
     Args:
         update_fields: The payload dictionary that will be sent in a patch/post request to the Airtable API
-        record: The individual record being processed
+        row: The :obj:`rule_pipeline.RecordRow` being processed
+        calendar: The :obj:`calendar_request.Calendar` instance corresponding to the calendar out of which we're working
 
     Returns:
         An updated-version of `update_fields` to be sent to airtable in a patch/post request
     """
-    deadline = get_in(record, ["fields", "Deadline"])
-    deadline_date = datetime.strptime(deadline, "%Y-%m-%d") + timedelta(hours=16)
-    deadline_group = get_in(record, ["fields", "Deadline Group"], "")
-    adjusted_datetime = datetime.today() - timedelta(hours=7)
+    deadline_group = row.get("Deadline Group", "")
     
-    if adjusted_datetime.date() == deadline_date.date() and deadline_group != 'Today':
+    if row.is_today and deadline_group != 'Today':
         update_fields.update({
             "Deadline Group": "Today",
         })
     return update_fields
 
 
-def transition_done_record(update_fields: dict, record: dict, calendar: Calendar) -> Dict:
+@register_rule
+def transition_done_record(update_fields: dict, row: RecordRow, calendar: Calendar) -> Dict:
     """ Transitions recently marked "Done" and "Abandoned" `Status` records
     
     Does the following for "Done" and "Abandoned" Records
-        1. Changes Google Calendar Event color to the completed color
+        1. Stages a Google Calendar Event color change to the completed color
         2. Sets the `lastStatus` field, which makes it an inactive record
 
     Args:
         update_fields: The payload dictionary that will be sent in a patch/post request to the Airtable API
-        record: The individual record being processed
+        row: The :obj:`rule_pipeline.RecordRow` being processed
         calendar: The :obj:`calendar_request.Calendar` instance corresponding to the calendar out of which we're working
 
     Returns:
         An updated-version of `update_fields` to be sent to airtable in a patch/post request
     """
-    status = get_in(record, ["fields", "Status"], "")
+    status = row.get("Status", "")
 
     if status == "Done" or status == "Abandoned":
         color_id = GCAL_COLOR_MAPPING[status]
-        calendar_event_id = get_in(record, ["fields", "calendarEventId"])
-        airtable_record_id = get_in(record, ["id"])
+        calendar_event_id = row.get("calendarEventId")
 
         if calendar_event_id:
-            calendar.patch_event(calendar_event_id, airtable_record_id, color_id=color_id)
+            calendar.stage_patch(calendar_event_id, row.id, color_id=color_id)
 
         update_fields.update({
             "lastStatus": "Done",
@@ -244,51 +387,384 @@ def transition_done_record(update_fields: dict, record: dict, calendar: Calendar
     return update_fields
 
 
-def update_records(calendar: Calendar, active_records: dict):
+def drain_staged_records(payload: dict, staged_records: list, table: Optional[AirtableTable] = None,
+                         journal: Optional[Journal] = None, calendar_failures: Iterable[str] = ()) -> Dict:
+    """ Moves staged record updates into the Airtable payload
+
+    Records are staged while their Gcal writes may still be queued in a batch request, since
+    the batch callbacks fill in fields such as `calendarEventId`. Once the calendar has no
+    pending writes, the staged records are complete: they are journaled, if a journal is
+    configured, and paged out to Airtable.
+
+    The updates of records whose Gcal write failed are dropped, so that the next run finds them
+    out of sync and redoes them (writing `lastDeadline` etc now would hide the failure).
+
+    Args:
+        payload: Airtable API-friendly dictionary with contents of request
+        staged_records: Records ({"id", "fields"}) waiting on their Gcal writes. Emptied in place.
+        table: (optional) The :obj:`airtable_request.AirtableTable` to write to, instead of the default table
+        journal: (optional) The :obj:`journal.Journal` of the run
+        calendar_failures: (optional) Ids of the records whose Gcal write failed
+
+    Returns:
+        The current (possibly freshly paged) Airtable payload
+    """
+    if calendar_failures:
+        staged_records[:] = [record for record in staged_records if record['id'] not in calendar_failures]
+    if journal:
+        journal.record(table_key(table), [record for record in staged_records if record['fields']])
+    for staged_record in staged_records:
+        if staged_record['fields']:
+            # paginate payload, if necessary
+            payload = update_payload_state(payload, 'patch', table)
+            payload['records'].append(staged_record)
+    staged_records.clear()
+    return payload
+
+
+def table_key(table: Optional[AirtableTable] = None) -> str:
+    """ Name ("base/table") of a table, defaulting to the default table """
+    table = table or default_table
+    return f'{table.base_name}/{table.table_name}'
+
+
+def replay_journal(journal: Journal, table: Optional[AirtableTable] = None) -> List:
+    """ Sends the record updates journaled by an interrupted run to Airtable
+
+    Args:
+        journal: The :obj:`journal.Journal` holding the pending updates
+        table: (optional) The :obj:`airtable_request.AirtableTable` to write to, instead of the default table
+
+    Returns:
+        The (payload, error) pairs of the Airtable requests that failed, whose updates stay journaled
+    """
+    pending = journal.pending(table_key(table))
+    if not pending:
+        return []
+    print(f'Resuming: replaying {len(pending)} journaled record updates')
+    payload = {"records": [], "typecast": True}
+    for record_id, fields in pending.items():
+        payload = update_payload_state(payload, 'patch', table)
+        payload['records'].append({"id": record_id, "fields": fields})
+    failed = send_nonempty_payload(payload, 'patch', table)
+    journal.clear(table_key(table), keep=[record['id'] for failed_payload, _ in failed
+                                          for record in failed_payload['records']])
+    metrics.count('journal.replayed', len(pending))
+    return failed
+
+
+def update_records(calendar: Calendar, active_records: Iterable[Record], calendar_changes: dict = None,
+                   table: Optional[AirtableTable] = None, journal: Optional[Journal] = None,
+                   budget: Optional[TimeBudget] = None):
     """ Patches Airtable with updates to `Deadline Group` field based off of deadline
 
-    Iterates through each active record, and applies the :func:`process_new_record`,
-    :func:`process_deadline_change`, :func:`transition_today_record`, and 
-    :func:`transition_done_record` logic methods. 
+    Parses the active records page by page into a :obj:`rule_pipeline.RecordPage`, then applies
+    every registered rule (:func:`process_calendar_change`, :func:`process_new_record`,
+    :func:`process_deadline_change`, :func:`process_name_change`, :func:`transition_today_record`,
+    and :func:`transition_done_record`) to each row. The Gcal changes staged by these methods
+    are merged and sent as a single patch per record. Records that become inactive are evicted
+    from the calendar's snapshot cache, if any.
 
     As the method iterates through the records, the :func:`update_payload_state` method
     handles the request paging to appease the Airtable API's limits. The leftover payload is
     sent to the Airtable API with :func:`send_nonempty_payload`
 
+    When the calendar is in batched mode, record updates are held back (see
+    :func:`drain_staged_records`) until the batch carrying their Gcal writes has been flushed.
+
+    With a :obj:`journal.Journal`, the updates left over by an interrupted run are replayed
+    first (see :func:`replay_journal`), before the active records are fetched. The replayed
+    updates that fail stay journaled, and are reported as failed.
+
+    With a :obj:`scheduler.TimeBudget`, the records are processed by priority, in smaller pages,
+    until the budget is spent; the ids of the records that did not fit are left in `budget.leftover`.
+
     Args: 
         calendar: The :obj:`calendar_request.Calendar` instance corresponding to the calendar out of which we're working
-        active_records: All of the active records in the Airtable table
+        active_records: All of the active :obj:`record_model.Record`, possibly streamed page by page
+        calendar_changes: (optional) Changed event start times by record id, from :func:`index_calendar_changes`
+        table: (optional) The :obj:`airtable_request.AirtableTable` to write to, instead of the default table
+        journal: (optional) The :obj:`journal.Journal` of the pending Airtable updates
+        budget: (optional) The :obj:`scheduler.TimeBudget` of the run
+
+    Returns:
+        The (payload, error) pairs of the Airtable requests that failed, plus a single-record pair
+        for every record left out because its Gcal write failed
     """
-    payload = {"records": [], "typecast": True}  
+    replay_failed = []
+    if journal:
+        with metrics.timer('replay_journal'):
+            replay_failed = replay_journal(journal, table)
 
-    for record in active_records['records']:
-        # paginate payload, if necessary
-        payload = update_payload_state(payload, 'patch')
-        
-        update_fields = dict()
-        update_fields = process_new_record(update_fields, record, calendar)
-        update_fields = process_deadline_change(update_fields, record, calendar)
-        update_fields = process_name_change(update_fields, record, calendar)
-        update_fields = transition_today_record(update_fields, record)
-        update_fields = transition_done_record(update_fields, record, calendar)
-
-        if update_fields:
-            payload['records'].append({
-                "id": record['id'],
+    payload = {"records": [], "typecast": True}  
+    staged_records = []
+    inactive_record_ids = []
+    calendar_changes = calendar_changes or dict()
+    if budget:
+        active_records = budget.dispatch(active_records)
+
+    for records in chunks(PAGE_SIZE if budget else MAX_AIRTABLE_PAGE, active_records):
+        page_started = time.monotonic()
+        with metrics.timer('parse_page'):
+            page = RecordPage(records, calendar_changes)
+        metrics.count('records.processed', len(page))
+
+        for row in page:
+            update_fields = dict()
+            for rule in RULES:
+                with metrics.timer('rule.' + rule.__name__):
+                    update_fields = rule(update_fields, row, calendar)
+            with metrics.timer('calendar.commit_patches'):
+                calendar.commit_patches()
+            if update_fields.get("lastStatus") == "Done":
+                inactive_record_ids.append(row.id)
+
+            staged_records.append({
+                "id": row.id,
                 "fields": update_fields
             })
 
-    # patch request to Airtable
-    send_nonempty_payload(payload, 'patch')
+            if not calendar.pending:
+                payload = drain_staged_records(payload, staged_records, table, journal, calendar.failed)
+        if budget:
+            budget.observe(len(page), time.monotonic() - page_started)
+
+    # send the last Gcal batch, then patch request to Airtable
+    calendar.flush()
+    payload = drain_staged_records(payload, staged_records, table, journal, calendar.failed)
+    failed = replay_failed + send_nonempty_payload(payload, 'patch', table)
+    if journal:
+        journal.clear(table_key(table), keep=[record['id'] for failed_payload, _ in failed
+                                              for record in failed_payload['records']])
+    calendar_failures, calendar.failed = calendar.failed, dict()
+    failed += [({"records": [{"id": record_id, "fields": {}}]}, error) for record_id, error in calendar_failures.items()]
+    report_failures(failed)
+    if calendar.snapshot_cache:
+        calendar.snapshot_cache.evict(inactive_record_ids)
+        calendar.snapshot_cache.save()
+    print(f'Coalesced Gcal patches: {calendar.patches_saved} API calls saved '
+          f'({calendar.patches_skipped} already up to date)')
+    metrics.count('calendar.patches_saved', calendar.patches_saved)
+    metrics.count('calendar.patches_skipped', calendar.patches_skipped)
+    return failed
+
+
+def report_failures(failed: List):
+    """ Prints the records a run could not sync, and why
+
+    Args:
+        failed: The (payload, error) pairs returned by :func:`update_records`
+    """
+    records = failed_records(failed)
+    if not records:
+        return
+    print(f'Sync failed for {len(records)} records, left for the next run:')
+    for record_id, error in records.items():
+        print(f'    {record_id}: {error}')
+    metrics.count('records.failed', len(records))
+
+
+def get_backlog_records(backlog: Dict, table: Optional[AirtableTable] = None) -> Iterator[Record]:
+    """ Streams the active records carried over from the previous run
 
+    Args:
+        backlog: Dict mapping the ids of the carried-over records to their event's changed start (or None)
+        table: (optional) The :obj:`airtable_request.AirtableTable` to query, instead of the default table
+
+    Returns:
+        Iterator over the records, queried MAX_CHANGED_RECORD_IDS at a time
+    """
+    return cat(get_active_records(record_ids=record_ids, table=table)
+               for record_ids in chunks(MAX_CHANGED_RECORD_IDS, list(backlog)))
+
+
+def skip_repeats(records: Iterable[Record], record_ids: Iterable[str]) -> Iterator[Record]:
+    """ Skips the repeats of the records whose id is in `record_ids`, e.g. backlog records also modified since
+
+    Only the ids that may repeat are tracked, so that streaming a whole table does not hold all its ids.
+    """
+    record_ids = set(record_ids)
+    seen = set()
+    for record in records:
+        if record.id in record_ids:
+            if record.id in seen:
+                continue
+            seen.add(record.id)
+        yield record
+
+
+def sync(calendar_id: str = CALENDAR_ID, table: Optional[AirtableTable] = None, state_store=None,
+         snapshot_cache=None, journal=None, deadline: Optional[float] = None):
+    """ Retrieves active records and then updates the records with outlined logic
+
+    When a state store is configured (see :func:`state_store.get_state_store`), the events
+    changed in Gcal since the last run are listed incrementally and applied to Airtable too,
+    and only the Airtable records modified since the last run are fetched (see :func:`get_watermark`).
+
+    With a `deadline`, records are processed by priority within a :obj:`scheduler.TimeBudget`.
+    The records that did not fit are saved as the table's backlog, and fetched again (along with
+    their pending Gcal changes) by the next run.
+
+    Args:
+        calendar_id: (optional) The Gcal UUID to sync, instead of `CALENDAR_ID`
+        table: (optional) The :obj:`airtable_request.AirtableTable` to sync, instead of the default table
+        state_store: (optional) The :obj:`state_store.StateStore` to use, instead of the configured one
+        snapshot_cache: (optional) The :obj:`snapshot_cache.SnapshotCache` to use, instead of the configured one
+        journal: (optional) The :obj:`journal.Journal` to use, instead of the configured one
+        deadline: (optional) `time.monotonic()` time by which the sync must be over
+    """
+    now = datetime.utcnow()
+    table = table or default_table
+    key_prefix = f'{table.base_name}/{table.table_name}:'
+    calendar = Calendar(calendar_id, batch=True, snapshot_cache=snapshot_cache or get_snapshot_cache())
+    state_store = state_store or get_state_store()
+    calendar_changes = dict()
+    new_changes = dict()
+    backlog = dict()
+    modified_since = None
+    if state_store:
+        new_changes = index_calendar_changes(calendar.list_changes(state_store))
+        modified_since = get_watermark(state_store, now, new_changes, key_prefix)
+        backlog = state_store.get(key_prefix + 'backlog') or dict()
+        calendar_changes = dict({record_id: start for record_id, start in backlog.items() if start}, **new_changes)
+
+    active_records = get_active_records(modified_since, new_changes.keys() if modified_since else (), table)
+    if backlog and modified_since:
+        active_records = skip_repeats(cat([active_records, get_backlog_records(backlog, table)]), backlog)
+    budget = TimeBudget(deadline, key_prefix, writer=table.writer) if deadline else None
 
-def sync():
-    """ Retrieves active records and then updates the records with outlined logic """
-    active_records = get_active_records()
-    calendar = Calendar(CALENDAR_ID)
     print("before update")
-    update_records(calendar, active_records)
+    with metrics.timer('update_records'):
+        failed = update_records(calendar, active_records, calendar_changes, table, journal or get_journal(), budget)
+
+    # only mark the Gcal changes as seen once they have reached Airtable
+    if state_store and not failed:
+        calendar.save_sync_token(state_store)
+        save_watermark(state_store, now, full_sweep=modified_since is None, key_prefix=key_prefix)
+        leftover = {record_id: calendar_changes.get(record_id) for record_id in budget.leftover} if budget else {}
+        if leftover or backlog:
+            state_store.set(key_prefix + 'backlog', leftover or None)
+
+
+def sync_calendar_changes(calendar_id: str = CALENDAR_ID, table: Optional[AirtableTable] = None,
+                          state_store=None, snapshot_cache=None, journal=None):
+    """ Applies the Gcal changes since the last run, touching only the affected Airtable records
+
+    Used when Gcal notifies of a change (see :mod:`daemon`): rather than sweeping the table, only
+    the records of the changed events are fetched and run through the rules. Falls back to a
+    regular :func:`sync` when too many events changed.
+
+    Args:
+        calendar_id: (optional) The Gcal UUID to sync, instead of `CALENDAR_ID`
+        table: (optional) The :obj:`airtable_request.AirtableTable` to sync, instead of the default table
+        state_store: The :obj:`state_store.StateStore` holding the calendar's sync token
+        snapshot_cache: (optional) The :obj:`snapshot_cache.SnapshotCache` to use, instead of the configured one
+        journal: (optional) The :obj:`journal.Journal` to use, instead of the configured one
+    """
+    calendar = Calendar(calendar_id, batch=True, snapshot_cache=snapshot_cache or get_snapshot_cache())
+    calendar_changes = index_calendar_changes(calendar.list_changes(state_store))
+    if len(calendar_changes) > MAX_CHANGED_RECORD_IDS:
+        return sync(calendar_id, table, state_store, snapshot_cache, journal)
+
+    if calendar_changes:
+        active_records = get_active_records(record_ids=calendar_changes.keys(), table=table)
+        with metrics.timer('update_records'):
+            failed = update_records(calendar, active_records, calendar_changes, table, journal or get_journal())
+        if failed:
+            return
+    calendar.save_sync_token(state_store)
+
+
+def load_sync_config() -> List[Dict]:
+    """ Loads the (base, table, calendar) pairs to sync
+
+    Returns:
+        The pairs listed in the JSON file at `SYNC_CONFIG_PATH`, or else the single pair
+        configured by the `BASE_NAME`, `TABLE_NAME` and `CALENDAR_ID` env variables
+    """
+    if os.getenv('SYNC_CONFIG_PATH'):
+        with open(os.getenv('SYNC_CONFIG_PATH')) as config_file:
+            return json.load(config_file)
+    return [{"base": BASE_NAME, "table": TABLE_NAME, "calendar_id": CALENDAR_ID}]
+
+
+class SyncFailedError(Exception):
+    """ Raised when pairs of a :func:`sync_all` run failed
+
+    Attributes:
+        errors: Dict mapping the name ("base/table") of each failed pair to its exception
+    """
+    def __init__(self, errors: Dict[str, Exception]):
+        super().__init__('Sync failed for ' + ', '.join(f'{name} ({error!r})' for name, error in errors.items()))
+        self.errors = errors
+
+
+@memoize
+def get_executor(max_workers: int) -> ThreadPoolExecutor:
+    """ Thread pool kept across warm invocations, so its threads keep their Calendar services """
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sync')
+
+
+def sync_all(pairs: Optional[List[Dict]] = None, max_workers: int = MAX_SYNC_WORKERS,
+             deadline: Optional[float] = None, state_store=None, snapshot_cache=None, journal=None) -> Dict:
+    """ Syncs every (base, table, calendar) pair concurrently
+
+    Each pair runs :func:`sync` on a bounded thread pool with its own Airtable session and
+    Calendar client; tables of the same base share the base's rate limiter. An error in one
+    pair does not stop the others.
+
+    The run's metrics are exported at the end (see :mod:`metrics`). When `SYNC_PROFILE_PATH`
+    is set, the pairs are synced one by one in the calling thread, so cProfile sees them.
+
+    Args:
+        pairs: (optional) Dicts with the "base", "table" and "calendar_id" of each pair,
+            defaulting to :func:`load_sync_config`
+        max_workers: (optional) Maximum number of pairs synced at the same time
+        deadline: (optional) `time.monotonic()` time by which every pair must be synced (see :func:`sync`)
+        state_store: (optional) The :obj:`state_store.StateStore` to use, instead of the configured one
+        snapshot_cache: (optional) The :obj:`snapshot_cache.SnapshotCache` to use, instead of the configured one
+        journal: (optional) The :obj:`journal.Journal` to use, instead of the configured one
+
+    Returns:
+        Dict mapping the name ("base/table") of each failed pair to its exception
+    """
+    pairs = pairs if pairs is not None else load_sync_config()
+    metrics.reset()
+    state_store = state_store or get_state_store()
+    snapshot_cache = snapshot_cache or get_snapshot_cache()
+    journal = journal or get_journal()
+    profiling = bool(os.getenv('SYNC_PROFILE_PATH'))
+    executor = get_executor(max_workers)
+    errors = dict()
+
+    with profiled(), metrics.timer('sync_all'):
+        futures = dict()
+        for pair in pairs:
+            table = get_table(pair["base"], pair["table"])
+            name = f'{pair["base"]}/{pair["table"]}'
+            args = (pair["calendar_id"], table, state_store, snapshot_cache, journal, deadline)
+            if profiling:
+                futures[name] = Future()
+                try:
+                    futures[name].set_result(sync(*args))
+                except Exception as error:
+                    futures[name].set_exception(error)
+            else:
+                futures[name] = executor.submit(sync, *args)
+
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as error:
+                print(f'Sync failed for {name}: {error!r}')
+                errors[name] = error
+
+    metrics.count('pairs.failed', len(errors))
+    metrics.export()
+    return errors
 
 
 if __name__ == "__main__":
-    sync()
+    errors = sync_all()
+    if errors:
+        raise SyncFailedError(errors)